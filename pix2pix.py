@@ -3,6 +3,7 @@ from __future__ import division
 from __future__ import print_function
 
 import tensorflow as tf
+from tensorflow.python.client import timeline
 import numpy as np
 import argparse
 import os
@@ -10,14 +11,25 @@ import json
 import glob
 import random
 import collections
+import fnmatch
 import math
 import time
 import sys
+import shutil
+import signal
+import threading
+import zlib
+try:
+    import queue # python 3
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    import Queue as queue # python 2
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 from tqdm import tqdm
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--input_dir", help="path to folder containing images")
-parser.add_argument("--mode", required=True, choices=["train", "test", "export"])
+parser.add_argument("--mode", required=True, choices=["train", "test", "export", "benchmark"])
 parser.add_argument("--output_dir", required=True, help="where to put output files")
 parser.add_argument("--seed", type=int)
 parser.add_argument("--checkpoint", default=None, help="directory with checkpoint to resume training from or use for testing")
@@ -25,13 +37,26 @@ parser.add_argument("--checkpoint", default=None, help="directory with checkpoin
 parser.add_argument("--max_examples", type=int, help="number of training steps (0 to disable)")
 parser.add_argument("--max_steps", type=int, help="number of training steps (0 to disable)")
 parser.add_argument("--max_epochs", type=int, help="number of training epochs")
-parser.add_argument("--summary_freq", type=int, default=400, help="update summaries every summary_freq steps")
+parser.add_argument("--summary_freq", type=int, default=400, help="update scalar summaries every summary_freq steps")
+parser.add_argument("--histogram_freq", type=int, help="update histogram and image summaries every histogram_freq steps, defaults to summary_freq")
+parser.add_argument("--histogram_vars", type=int, default=0, help="number of variables to record histograms of values and gradients for, chosen at random, 0 for all of them")
 parser.add_argument("--progress_freq", type=int, default=200, help="display progress every progress_freq steps")
-parser.add_argument("--trace_freq", type=int, default=0, help="trace execution every trace_freq steps")
+parser.add_argument("--trace_freq", type=int, default=0, help="trace execution every trace_freq steps, and write a chrome trace timeline for each traced step")
 parser.add_argument("--display_freq", type=int, default=0, help="write current training images every display_freq steps")
+parser.add_argument("--display_count", type=int, default=0, help="number of images from the batch to write every display_freq steps, 0 for the whole batch")
 parser.add_argument("--save_freq", type=int, default=200, help="save model every save_freq steps, 0 to disable")
+parser.add_argument("--save_secs", type=int, default=0, help="also save model every save_secs seconds, 0 to disable")
+parser.add_argument("--async_save", action="store_true", help="write checkpoints from a background thread, training only waits while the variables are copied out of the session")
+parser.add_argument("--max_to_keep", type=int, default=1, help="number of most recent checkpoints to keep")
+parser.add_argument("--keep_checkpoint_every_n_hours", type=float, default=10000.0, help="also keep one checkpoint for every this many hours of training")
+parser.add_argument("--keep_best", type=int, default=0, help="also keep this many checkpoints with the lowest gen_loss_L1 in output_dir/best, 0 to disable")
+parser.add_argument("--preemption_secs", type=float, default=30.0, help="on SIGTERM, wait at most this many seconds for the final checkpoint to be written")
+parser.add_argument("--telemetry", action="store_true", help="write the time spent waiting for the input queue, running the step, and on summaries, display images and saving for every step to output_dir/telemetry.jsonl")
+parser.add_argument("--metrics_port", type=int, default=0, help="with --telemetry, serve the latest step timings on this port at http://localhost:<port>/metrics")
+parser.add_argument("--steps_per_run", type=int, default=1, help="run up to this many training steps in a single session.run between steps that fetch progress, summaries, display images, traces or save the model")
 
 parser.add_argument("--batch_size", type=int, default=100, help="number of images in batch")
+parser.add_argument("--queue_capacity", type=int, default=32, help="number of examples to keep decoded ahead of training")
 parser.add_argument("--which_direction", type=str, default="AtoB", choices=["AtoB", "BtoA"])
 parser.add_argument("--ngf", type=int, default=96, help="number of generator filters in first conv layer")
 parser.add_argument("--ndf", type=int, default=96, help="number of discriminator filters in first conv layer")
@@ -43,15 +68,30 @@ parser.add_argument("--dropout", type=float, default=0.5, help="dropout rate")
 parser.add_argument("--skip_layers", type=bool, default=False, help="add skip layers")
 parser.add_argument("--convolution", type=bool, default=False, help="use convolution")
 parser.add_argument("--lstm", type=bool, default=False, help="use LSTM")
+parser.add_argument("--micro_batches", type=int, default=1, help="split each batch into this many parts that are run one at a time, adding up their gradients and applying them once for the whole batch")
+parser.add_argument("--recompute", default="", help="comma separated list of variable scope patterns, e.g. generator/generator_rnn_*,generator/generator_lstm/*, whose activations are recomputed during the backward pass instead of kept in memory")
+
+# session options
+parser.add_argument("--intra_op_threads", type=int, default=0, help="number of threads to use within an op, 0 for the tensorflow default")
+parser.add_argument("--inter_op_threads", type=int, default=0, help="number of ops to run in parallel, 0 for the tensorflow default")
+
+# benchmark options
+parser.add_argument("--benchmark_steps", type=int, default=20, help="number of steps to time for each part of the model in benchmark mode")
+
+# streaming options
+parser.add_argument("--stream", action="store_true", help="in test mode, run the generator over overlapping windows of input images of any width instead of over A/B pairs")
+parser.add_argument("--stream_stride", type=int, default=128, help="number of columns between the starts of consecutive windows with --stream")
 
 # export options
 parser.add_argument("--output_filetype", default="png", choices=["png", "jpeg"])
 a = parser.parse_args()
 
 EPS = 1e-12
+IMAGE_HEIGHT = 64
+IMAGE_WIDTH = 256
 
-Examples = collections.namedtuple("Examples", "paths, inputs, targets, count, steps_per_epoch")
-Model = collections.namedtuple("Model", "outputs, predict_real, predict_fake, discrim_loss, discrim_grads_and_vars, gen_loss_GAN, gen_loss_L1, gen_grads_and_vars, train")
+Examples = collections.namedtuple("Examples", "paths, inputs, targets, count, steps_per_epoch, next_batch, queue_size, queue_wait")
+Model = collections.namedtuple("Model", "outputs, predict_real, predict_fake, discrim_loss, discrim_grads_and_vars, gen_loss_GAN, gen_loss_L1, gen_grads_and_vars, train, discrim_optim, gen_optim")
 
 
 def preprocess(image):
@@ -78,11 +118,13 @@ def conv(batch_input, out_channels, stride, filter_size = 4):
 
 def deconv(batch_input, out_channels, stride = 2, filter_size = 4):
     with tf.variable_scope("deconv"):
-        batch, in_height, in_width, in_channels = [int(d) for d in batch_input.get_shape()]
+        in_channels = int(batch_input.get_shape()[3])
         filter = tf.get_variable("filter", [filter_size, filter_size, out_channels, in_channels], dtype=tf.float32, initializer=tf.truncated_normal_initializer(0, 0.2))
+        # use the dynamic shape so that the same weights can be run on tiles of any width
+        batch, in_height, in_width = tf.unstack(tf.shape(batch_input)[:3])
         # [batch, in_height, in_width, in_channels], [filter_width, filter_height, out_channels, in_channels]
         #     => [batch, out_height, out_width, out_channels]
-        conv = tf.nn.conv2d_transpose(batch_input, filter, [batch, in_height * stride, in_width * stride, out_channels], [1, stride, stride, 1], padding="SAME")
+        conv = tf.nn.conv2d_transpose(batch_input, filter, tf.stack([batch, in_height * stride, in_width * stride, out_channels]), [1, stride, stride, 1], padding="SAME")
         return conv
 
 
@@ -155,7 +197,7 @@ def lrelu(x, a):
         return (0.5 * (1 + a)) * x + (0.5 * (1 - a)) * tf.abs(x)
 
 
-def batchnorm(input):
+def batchnorm(input, training=True, decay=0.99, update=True):
     with tf.variable_scope("batchnorm"):
         # this block looks like it has 3 inputs on the graph unless we do this
         input = tf.identity(input)
@@ -163,15 +205,123 @@ def batchnorm(input):
         channels = input.get_shape()[3]
         offset = tf.get_variable("offset", [channels], dtype=tf.float32, initializer=tf.zeros_initializer())
         scale = tf.get_variable("scale", [channels], dtype=tf.float32, initializer=tf.truncated_normal_initializer(1.0, 0.02))
-        mean, variance = tf.nn.moments(input, axes=[0, 1, 2], keep_dims=False)
+        moving_mean = tf.get_variable("moving_mean", [channels], dtype=tf.float32, initializer=tf.zeros_initializer(), trainable=False)
+        moving_variance = tf.get_variable("moving_variance", [channels], dtype=tf.float32, initializer=tf.ones_initializer(), trainable=False)
+        if training:
+            mean, variance = tf.nn.moments(input, axes=[0, 1, 2], keep_dims=False)
+        if training and update:
+            # keep running averages of the batch statistics so the model can be run in inference mode,
+            # where the output for a pixel does not depend on the rest of the batch
+            moments = (moving_mean, moving_variance, decay, mean, variance)
+            if batchnorm_moments is not None:
+                batchnorm_moments.append(moments)
+            else:
+                update_moving_averages([moments])
+        if not training:
+            mean, variance = moving_mean, moving_variance
         variance_epsilon = 1e-5
         normalized = tf.nn.batch_normalization(input, mean, variance, offset, scale, variance_epsilon=variance_epsilon)
         return normalized
 
 
+def collect_moments(fn, *args):
+    # fn(*args) with the batch moments of its batchnorm layers returned instead of used to update the moving averages
+    global batchnorm_moments
+    outer = batchnorm_moments
+    batchnorm_moments = []
+    try:
+        return fn(*args), batchnorm_moments
+    finally:
+        batchnorm_moments = outer
+
+
+def update_moving_averages(moments):
+    # adds one update to UPDATE_OPS for each batchnorm layer, a layer that is used more than once in the model,
+    # like those of the real and fake discriminators, is updated with the moments of all of its uses combined
+    # as if they were a single batch
+    layers = collections.OrderedDict()
+    for moving_mean, moving_variance, decay, mean, variance in moments:
+        layers.setdefault(moving_mean.op.name, (moving_mean, moving_variance, decay, []))[3].append((mean, variance))
+
+    for moving_mean, moving_variance, decay, uses in layers.values():
+        if len(uses) == 1:
+            mean, variance = uses[0]
+        else:
+            mean = tf.add_n([mean for mean, _ in uses]) / len(uses)
+            # the mean of E[x^2] over the uses minus the square of the combined mean
+            variance = tf.add_n([variance + tf.square(mean) for mean, variance in uses]) / len(uses) - tf.square(mean)
+        tf.add_to_collection(tf.GraphKeys.UPDATE_OPS, tf.assign(moving_mean, moving_mean * decay + mean * (1 - decay)))
+        tf.add_to_collection(tf.GraphKeys.UPDATE_OPS, tf.assign(moving_variance, moving_variance * decay + variance * (1 - decay)))
+
+
+def restorer(checkpoint, var_list=None):
+    # returns a function that restores var_list, all global variables by default, from checkpoint
+    # checkpoints written before batchnorm kept moving averages have no moving_mean or moving_variance,
+    # those are set to their initial values instead of failing the restore
+    if var_list is None:
+        var_list = tf.global_variables()
+    saved = set(name for name, _ in tf.train.list_variables(checkpoint))
+    missing = [var for var in var_list if var.op.name not in saved and var.op.name.split("/")[-1] in ["moving_mean", "moving_variance"]]
+    missing_names = set(var.op.name for var in missing)
+    saver = tf.train.Saver([var for var in var_list if var.op.name not in missing_names])
+    init_missing = tf.variables_initializer(missing)
+
+    def restore(sess):
+        if len(missing) > 0:
+            print("warning: %s has no batchnorm moving averages, inference mode will normalize with mean 0 and variance 1 until the model is trained further" % checkpoint)
+            sess.run(init_missing)
+        saver.restore(sess, checkpoint)
+    return restore
+
+
+def has_moving_averages(checkpoint):
+    return any(name.split("/")[-1] == "moving_mean" for name, _ in tf.train.list_variables(checkpoint))
+
 
 
 
+# set by collect_moments to a list that batchnorm adds its batch moments to instead of updating the moving averages,
+# so that the moments of every use of a layer, and with --micro_batches of every part of the batch, can be combined
+batchnorm_moments = None
+
+# passed to the function of a segment, with --recompute the function is built a second time for the backward pass,
+# batchnorm skips its moving average updates then so that they are not applied twice, and dropout uses seed in both
+# passes so that the recomputed activations are the ones the loss was computed from
+SegmentPass = collections.namedtuple("SegmentPass", "is_recomputing, seed")
+
+
+def segment(name, fn, *inputs):
+    # fn(*inputs, segment_pass) in variable scope name, if the scope matches --recompute then only the inputs are kept
+    # for the backward pass and the activations inside the segment are computed again from them
+    scope_name = name if tf.get_variable_scope().name == "" else tf.get_variable_scope().name + "/" + name
+    patterns = [pattern for pattern in a.recompute.split(",") if pattern != ""]
+    if not any(fnmatch.fnmatch(scope_name, pattern) for pattern in patterns):
+        with tf.variable_scope(name):
+            return fn(*(inputs + (SegmentPass(is_recomputing=False, seed=None),)))
+
+    seed = zlib.crc32(scope_name.encode("utf8")) & 0x7fffffff
+    # recompute_grad only passes is_recomputing to a function that has it as a named argument, so the inputs
+    # are named as well, recompute_grad leaves out the ones that a segment does not have
+    def recomputable(input_0, input_1=None, input_2=None, is_recomputing=False):
+        segment_inputs = tuple(input for input in [input_0, input_1, input_2] if input is not None)
+        outputs = fn(*(segment_inputs + (SegmentPass(is_recomputing=is_recomputing, seed=seed),)))
+        # recompute_grad only returns gradients for the variables it sees being read, which does not include those
+        # only read inside a while loop, like the LSTM weights in tf.nn.dynamic_rnn, so read them here as well
+        for var in tf.trainable_variables(tf.get_variable_scope().name + "/"):
+            var.read_value()
+        return outputs
+
+    if len(inputs) > 3:
+        raise Exception("a segment takes at most 3 inputs")
+    # recompute_grad only supports resource variables, and only takes tensors, not the variables that benchmark mode uses as inputs
+    with tf.variable_scope(name, use_resource=True):
+        return tf.contrib.layers.recompute_grad(recomputable)(*[tf.convert_to_tensor(input) for input in inputs])
+
+
+def dropout(x, rate, seed=None):
+    return tf.nn.dropout(x, keep_prob=1 - rate, seed=seed)
+
+
 def check_image(image):
     assertion = tf.assert_equal(tf.shape(image)[-1], 1, message="image must have 1 color channels")
     with tf.control_dependencies([assertion]):
@@ -192,17 +342,35 @@ def load_examples():
     if a.input_dir is None or not os.path.exists(a.input_dir):
         raise Exception("input_dir does not exist")
 
-    input_paths = glob.glob(os.path.join(a.input_dir, "*.jpg"))
-    decode = tf.image.decode_jpeg
-    if len(input_paths) == 0:
+    # packed examples written by tools/process.py --operation prepare --pack
+    record_paths = glob.glob(os.path.join(a.input_dir, "*.tfrecords"))
+
+    if os.path.isfile(a.input_dir):
+        # split manifest written by tools/split.py --manifest, with one image name per line
+        with open(a.input_dir) as f:
+            input_paths = [os.path.join(os.path.dirname(a.input_dir), line.strip()) for line in f if line.strip() != ""]
+        record_paths = []
+        decode = tf.image.decode_png
+        if any(path.lower().endswith(".jpg") for path in input_paths):
+            decode = tf.image.decode_jpeg
+    else:
+        input_paths = glob.glob(os.path.join(a.input_dir, "*.jpg"))
+        decode = tf.image.decode_jpeg
+    if len(record_paths) > 0:
+        with open(os.path.join(a.input_dir, "examples.json")) as f:
+            count = json.loads(f.read())["count"]
+        if a.max_examples:
+            count = min(count, a.max_examples)
+    elif len(input_paths) == 0:
         input_paths = glob.glob(os.path.join(a.input_dir, "*.png"))
         decode = tf.image.decode_png
 
-    if len(input_paths) == 0:
+    if len(record_paths) == 0 and len(input_paths) == 0:
         raise Exception("input_dir contains no image files")
     
     if a.max_examples and len(input_paths) > a.max_examples:        
         input_paths = input_paths[:a.max_examples]
+    count = len(input_paths) if len(record_paths) == 0 else count
         
 
     
@@ -218,9 +386,28 @@ def load_examples():
         input_paths = sorted(input_paths)
 
     with tf.name_scope("load_images"):
-        path_queue = tf.train.string_input_producer(input_paths, shuffle=a.mode == "train")
-        reader = tf.WholeFileReader()
-        paths, contents = reader.read(path_queue)
+        if len(record_paths) > 0:
+            # one sequential read per example instead of opening a file for each one
+            if a.max_examples:
+                # only read the first max_examples records, not just fewer steps per epoch over all of them
+                records = tf.data.TFRecordDataset(sorted(record_paths)).take(a.max_examples).repeat()
+                serialized = records.make_one_shot_iterator().get_next()
+            else:
+                record_queue = tf.train.string_input_producer(record_paths, shuffle=a.mode == "train")
+                reader = tf.TFRecordReader()
+                _, serialized = reader.read(record_queue)
+            features = tf.parse_single_example(serialized, features={
+                "path": tf.FixedLenFeature([], tf.string),
+                "image": tf.FixedLenFeature([], tf.string),
+            })
+            paths, contents = features["path"], features["image"]
+            # tools/download-dataset.py --pack keeps the original jpg files
+            def decode(contents, channels, dtype):
+                return tf.cond(tf.image.is_jpeg(contents), lambda: tf.image.decode_jpeg(contents, channels=channels), lambda: tf.image.decode_png(contents, channels=channels, dtype=dtype))
+        else:
+            path_queue = tf.train.string_input_producer(input_paths, shuffle=a.mode == "train")
+            reader = tf.WholeFileReader()
+            paths, contents = reader.read(path_queue)
         raw_input = tf.squeeze(decode(contents, channels = 1, dtype=tf.uint8))
         raw_input.set_shape([64, 512])
         raw_input = tf.image.convert_image_dtype(raw_input, dtype=tf.float32)
@@ -246,26 +433,57 @@ def load_examples():
     else:
         raise Exception("invalid direction")
 
-    paths_batch, inputs_batch, targets_batch = tf.train.batch([paths, input_images, target_images], batch_size=a.batch_size)
-    steps_per_epoch = int(math.ceil(len(input_paths) / a.batch_size))
+    # same queues as tf.train.batch and tf.train.shuffle_batch, but kept so that --steps_per_run
+    # can dequeue a new batch for each step of its loop
+    with tf.name_scope("batch"):
+        dtypes = [tf.string, tf.float32, tf.float32]
+        shapes = [[], input_images.get_shape(), target_images.get_shape()]
+        if len(record_paths) > 0 and a.mode == "train":
+            # records are read in order within a file, so shuffle them in memory as well
+            capacity = 1000 + 3 * a.batch_size
+            queue = tf.RandomShuffleQueue(capacity, min_after_dequeue=1000, dtypes=dtypes, shapes=shapes)
+        else:
+            capacity = a.queue_capacity
+            queue = tf.FIFOQueue(capacity, dtypes=dtypes, shapes=shapes)
+        tf.train.add_queue_runner(tf.train.QueueRunner(queue, [queue.enqueue([paths, input_images, target_images])]))
+        tf.summary.scalar("fraction_of_%d_full" % capacity, tf.cast(queue.size(), tf.float32) / capacity)
+
+    def next_batch():
+        return queue.dequeue_many(a.batch_size)
+
+    # the size of the queue before the dequeue and how long the dequeue waits, fetched along with the training step
+    # by --telemetry so that measuring them does not need a session.run of its own
+    queue_size = queue.size()
+    with tf.control_dependencies([queue_size]):
+        dequeue_start = tf.timestamp()
+    with tf.control_dependencies([dequeue_start]):
+        paths_batch, inputs_batch, targets_batch = next_batch()
+    with tf.control_dependencies([paths_batch, inputs_batch, targets_batch]):
+        queue_wait = tf.timestamp() - dequeue_start
+    steps_per_epoch = int(math.ceil(count / a.batch_size))
 
     return Examples(
         paths=paths_batch,
         inputs=inputs_batch,
         targets=targets_batch,
-        count=len(input_paths),
+        count=count,
         steps_per_epoch=steps_per_epoch,
+        next_batch=next_batch,
+        queue_size=queue_size,
+        queue_wait=queue_wait,
     )
 
 
-def create_generator(generator_inputs):
+def create_generator(generator_inputs, training=True):
     layers = []
 
     if a.convolution:
+        # [batch, height, width] => [batch, height, width, 1]
+        generator_inputs = tf.expand_dims(generator_inputs, axis=3)
+
         # encoder_1: [batch, 256, 256, in_channels] => [batch, 32, 32, ngf * 4]
-        with tf.variable_scope("encoder_1"):
-            output = conv(generator_inputs, a.ngf * 4, stride=8, filter_size=8)
-            layers.append(output)
+        output = segment("encoder_1", lambda x, segment_pass: conv(x, a.ngf * 4, stride=8, filter_size=8), generator_inputs)
+        layers.append(output)
 
         layer_specs = [
              a.ngf * 4, # encoder_4: [batch, 32, 32, ngf * 4] => [batch, 16, 16, ngf * 4]
@@ -276,23 +494,27 @@ def create_generator(generator_inputs):
         ]
     
         for out_channels in layer_specs:
-            with tf.variable_scope("encoder_%d" % (len(layers) + 1)):
+            def encoder(output, segment_pass, out_channels=out_channels):
                 output = lrelu(output, 0.2)
                 # [batch, in_height, in_width, in_channels] => [batch, in_height/2, in_width/2, out_channels]
                 output = conv(output, out_channels, stride=2)
-                output = batchnorm(output)
-                layers.append(output)
+                return batchnorm(output, training, update=not segment_pass.is_recomputing)
+            output = segment("encoder_%d" % (len(layers) + 1), encoder, output)
+            layers.append(output)
                 
         # add 16 highway layers
         for level in range(4):
-            with tf.variable_scope("generator_rnn_%d" % level):#, reuse = (level > 0)) as scope:
+            def generator_rnn(output, segment_pass):
                 out_channels = a.ngf * 4
                 output = lrelu(output, 0.2)
                 # [batch, in_height, in_width, in_channels] => [batch, in_height/2, in_width/2, out_channels]
                 output = conv(output, out_channels, stride=1)
-                output = batchnorm(output)
-                output = tf.nn.dropout(output, keep_prob=1 - a.dropout)
-                layers.append(output)            
+                output = batchnorm(output, training, update=not segment_pass.is_recomputing)
+                if training:
+                    output = dropout(output, a.dropout, segment_pass.seed)
+                return output
+            output = segment("generator_rnn_%d" % level, generator_rnn, output)
+            layers.append(output)            
     
     
         #for out_channels in layer_specs:
@@ -309,168 +531,201 @@ def create_generator(generator_inputs):
         ]
     
         num_encoder_layers = len(layers)
-        for decoder_layer, (out_channels, dropout) in enumerate(layer_specs):
-            with tf.variable_scope("decoder_%d" % (len(layer_specs) + 1 - decoder_layer)):
+        for decoder_layer, (out_channels, rate) in enumerate(layer_specs):
+            def decoder(output, segment_pass, out_channels=out_channels, rate=rate):
                 output = tf.nn.relu(output)
                 # [batch, in_height, in_width, in_channels] => [batch, in_height*2, in_width*2, out_channels]
                 output = deconv(output, out_channels)
-                output = batchnorm(output)
-    
-                if dropout > 0.0:
-                    output = tf.nn.dropout(output, keep_prob=1 - dropout)
+                output = batchnorm(output, training, update=not segment_pass.is_recomputing)
     
-                layers.append(output)
+                if training and rate > 0.0:
+                    output = dropout(output, rate, segment_pass.seed)
+                return output
+            output = segment("decoder_%d" % (len(layer_specs) + 1 - decoder_layer), decoder, output)
+            layers.append(output)
                 
         # decoder_1: [batch, 128, 128, ngf * 2] => [batch, 256, 256, generator_outputs_channels]
-        with tf.variable_scope("decoder_1"):
-            output = tf.nn.relu(output)
-            output = deconv(output, out_channels = 1, stride=8, filter_size=8)
-            output = tf.tanh(output)
-            layers.append(output)
+        output = segment("decoder_1", lambda x, segment_pass: tf.tanh(deconv(tf.nn.relu(x), out_channels = 1, stride=8, filter_size=8)), output)
+        layers.append(output)
+
+        # [batch, height, width, 1] => [batch, height, width]
+        output = tf.squeeze(output, axis=3)
                 
     elif a.lstm:
         with tf.variable_scope("generator_lstm"):
             output = generator_inputs
             
-            with tf.variable_scope("encoder"):
+            # the state is passed between the segments as separate tensors, which is what recompute_grad takes
+            def encoder(output, segment_pass):
                 cell = tf.contrib.rnn.LSTMBlockCell(2048)
-                output, final_state = tf.nn.dynamic_rnn(cell, output, dtype=tf.float32, 
-                                                        sequence_length=tf.constant(128, shape=(a.batch_size,)))
+                output, final_state = tf.nn.dynamic_rnn(cell, output, dtype=tf.float32, parallel_iterations=1,
+                                                        sequence_length=tf.fill([tf.shape(output)[0]], 128))
+                return output, final_state.c, final_state.h
+            output, c, h = segment("encoder", encoder, output)
                 
-            with tf.variable_scope("decoder"):
+            def decoder(output, c, h, segment_pass):
                 cell = tf.contrib.rnn.LSTMBlockCell(2048)
-                output, final_state = tf.nn.dynamic_rnn(cell, output, dtype=tf.float32, initial_state=final_state,
-                                                        sequence_length=tf.constant(128, shape=(a.batch_size,))) 
-                output = output[:,:,::8]
+                output, final_state = tf.nn.dynamic_rnn(cell, output, dtype=tf.float32, parallel_iterations=1, initial_state=tf.contrib.rnn.LSTMStateTuple(c, h),
+                                                        sequence_length=tf.fill([tf.shape(output)[0]], 128)) 
+                return output[:,:,::8]
+            output = segment("decoder", decoder, output, c, h)
 
     return output
 
 
-def create_model(inputs, targets):
-    
-    with tf.variable_scope("generator"):
-        outputs = create_generator(inputs)
+def generator_layers():
+    # (filter_size, stride, transposed) for each layer of the convolution generator along the width,
+    # all with SAME padding, used to work out which output columns depend on which input columns
+    # this must be kept in sync with create_generator
+    return [(8, 8, False), (4, 2, False), (4, 2, False)] + [(4, 1, False)] * 4 + [(4, 2, True), (4, 2, True), (8, 8, True)]
 
-    
-    if a.gan_weight: 
-        def create_discriminator(discrim_inputs, discrim_targets):
-                            
-            if a.convolution:
-                layers = []
-    
-                # 2x [batch, height, width, in_channels] => [batch, height, width, in_channels * 2]
-                input = tf.concat([discrim_inputs, discrim_targets], axis=3)
+
+def create_uint8_generator(input, reuse=False):
+    # [batch, height, width] uint8 => [batch, height, width] uint8 with batchnorm in inference mode
+    with tf.variable_scope("generator", reuse=reuse):
+        output = create_generator(preprocess(tf.image.convert_image_dtype(input, dtype=tf.float32)), training=False)
+    return tf.image.convert_image_dtype(deprocess(output), dtype=tf.uint8, saturate=True)
+
+
+def create_model(inputs, targets, share=None, training=True):
+    # share is an existing model to reuse the optimizers of, for a copy of the model created with reuse=True
+    # training=False runs the generator with the batchnorm moving averages and without dropout
+    update_ops_start = len(tf.get_collection(tf.GraphKeys.UPDATE_OPS))
+
+    def create_discriminator(discrim_inputs, discrim_targets):
+                        
+        if a.convolution:
+            layers = []
+
+            # 2x [batch, height, width] => [batch, height, width, 2]
+            input = tf.stack([discrim_inputs, discrim_targets], axis=3)
+            
+            # layer_1: [batch, 256, 256, in_channels * 2] => [batch, 128, 128, ndf]
+            output = segment("layer_1", lambda x, segment_pass: lrelu(conv(x, a.ndf * 4, stride=8, filter_size=8), 0.2), input)
+            layers.append(output)
                 
-                # layer_1: [batch, 256, 256, in_channels * 2] => [batch, 128, 128, ndf]
-                with tf.variable_scope("layer_1"):
-                    output = conv(input, a.ndf * 4, stride=8, filter_size=8)
-                    output = lrelu(output, 0.2)
-                    layers.append(output)
+            # layer_4: [batch, 32, 32, ndf * 4] => [batch, 16, 16, ndf * 4]
+            # layer_5: [batch, 16, 16, ndf * 4] => [batch, 8, 8, ndf * 4]
+            def layer(output, segment_pass):
+                out_channels = a.ndf * 4 #a.ndf * min(2**(i+1), 8)
+                output = conv(output, out_channels, stride=2)
+                output = batchnorm(output, update=not segment_pass.is_recomputing)
+                return lrelu(output, 0.2)
+            for i in range(2):
+                output = segment("layer_%d" % (len(layers) + 1), layer, output)
+                layers.append(output)
+
+            n_layers = 4
+            # layer_4: [batch, 8, 8, ndf * 4] => [batch, 8, 8, ndf * 4]
+            def discriminator_rnn(output, segment_pass):
+                out_channels = a.ndf * 4 #a.ndf * min(2**(i+1), 8)
+                output = conv(output, out_channels, stride=1)
+                output = batchnorm(output, update=not segment_pass.is_recomputing)
+                output = lrelu(output, 0.2)
+                return dropout(output, a.dropout, segment_pass.seed)
+            for level in range(n_layers):
+                output = segment("discriminator_rnn_%d" % level, discriminator_rnn, output)
+                layers.append(output)
                     
-                # layer_4: [batch, 32, 32, ndf * 4] => [batch, 16, 16, ndf * 4]
-                # layer_5: [batch, 16, 16, ndf * 4] => [batch, 8, 8, ndf * 4]
-                for i in range(2):
-                    with tf.variable_scope("layer_%d" % (len(layers) + 1)):
-                        out_channels = a.ndf * 4 #a.ndf * min(2**(i+1), 8)
-                        output = conv(output, out_channels, stride=2)
-                        output = batchnorm(output)
-                        output = lrelu(output, 0.2)
-                        layers.append(output)
-    
-                n_layers = 4
-                # layer_4: [batch, 8, 8, ndf * 4] => [batch, 8, 8, ndf * 4]
-                for level in range(n_layers):
-                    with tf.variable_scope("discriminator_rnn_%d" % level):#, reuse = (i > 0)):
-                        out_channels = a.ndf * 4 #a.ndf * min(2**(i+1), 8)
-                        output = conv(output, out_channels, stride=1)
-                        output = batchnorm(output)
-                        output = lrelu(output, 0.2)
-                        output = tf.nn.dropout(output, keep_prob=1 - a.dropout)
-                        layers.append(output)
-                        
-                        
-                # layer_5: [batch, 8, 8, ndf * 4] => [batch, 8, 8, 1]
-                with tf.variable_scope("layer_%d" % (len(layers) + 1)):
-                    output = conv(output, out_channels=1, stride=1)
-                    output = tf.sigmoid(output)
-                    layers.append(output)
-    
-                        
-            elif a.lstm:
-                with tf.variable_scope("discriminator_lstm"):
-                    def f(output): 
-                        cell = tf.contrib.rnn.LSTMBlockCell(256)
-                        output, final_state = tf.nn.dynamic_rnn(cell, output, dtype=tf.float32)
-                        return output
-                                                
-                    with tf.variable_scope("encode_inputs"):
-                        encoded_inputs = f(discrim_inputs)
-    
-                    with tf.variable_scope("encode_targets"):
-                        encoded_targets = f(discrim_targets)
-                        
-                        
-                    #output = tf.concat([encoded_inputs, encoded_targets], axis=3)
-                    output = tf.abs(encoded_inputs - encoded_targets)
-                    output = tf.sigmoid(output)
-    
-            return output
-    
-        
-        # create two copies of discriminator, one for real pairs and one for fake pairs
-        # they share the same underlying variables
-        with tf.name_scope("real_discriminator"):
-            with tf.variable_scope("discriminator"):
-                # 2x [batch, height, width, channels] => [batch, 30, 30, 1]
-                predict_real = create_discriminator(inputs, targets)
-    
-        with tf.name_scope("fake_discriminator"):
-            with tf.variable_scope("discriminator", reuse=True):
-                # 2x [batch, height, width, channels] => [batch, 30, 30, 1]
-                predict_fake = create_discriminator(inputs, outputs)
+                    
+            # layer_5: [batch, 8, 8, ndf * 4] => [batch, 8, 8, 1]
+            with tf.variable_scope("layer_%d" % (len(layers) + 1)):
+                output = conv(output, out_channels=1, stride=1)
+                output = tf.sigmoid(output)
+                layers.append(output)
+
+                    
+        elif a.lstm:
+            with tf.variable_scope("discriminator_lstm"):
+                def f(output, segment_pass): 
+                    cell = tf.contrib.rnn.LSTMBlockCell(256)
+                    output, final_state = tf.nn.dynamic_rnn(cell, output, dtype=tf.float32)
+                    return output
+                                            
+                encoded_inputs = segment("encode_inputs", f, discrim_inputs)
+                encoded_targets = segment("encode_targets", f, discrim_targets)
+                    
+                    
+                #output = tf.concat([encoded_inputs, encoded_targets], axis=3)
+                output = tf.abs(encoded_inputs - encoded_targets)
+                output = tf.sigmoid(output)
+
+        return output
+
+    def create_losses(inputs, targets):
+        with tf.variable_scope("generator"):
+            outputs = create_generator(inputs, training)
+
+        if a.gan_weight: 
+            # create two copies of discriminator, one for real pairs and one for fake pairs
+            # they share the same underlying variables
+            with tf.name_scope("real_discriminator"):
+                with tf.variable_scope("discriminator"):
+                    # 2x [batch, height, width, channels] => [batch, 30, 30, 1]
+                    predict_real = create_discriminator(inputs, targets)
     
-        with tf.name_scope("discriminator_loss"):
-            # minimizing -tf.log will try to get inputs to 1
-            # predict_real => 1
-            # predict_fake => 0
-            discrim_loss = tf.reduce_mean(-(tf.log(predict_real + EPS) + tf.log(1 - predict_fake + EPS)))
+            with tf.name_scope("fake_discriminator"):
+                with tf.variable_scope("discriminator", reuse=True):
+                    # 2x [batch, height, width, channels] => [batch, 30, 30, 1]
+                    predict_fake = create_discriminator(inputs, outputs)
     
-        with tf.name_scope("generator_loss_gan"):
-            gen_loss_GAN = tf.reduce_mean(-tf.log(predict_fake + EPS))
+            with tf.name_scope("discriminator_loss"):
+                # minimizing -tf.log will try to get inputs to 1
+                # predict_real => 1
+                # predict_fake => 0
+                discrim_loss = tf.reduce_mean(-(tf.log(predict_real + EPS) + tf.log(1 - predict_fake + EPS)))
     
-                 
+            with tf.name_scope("generator_loss_gan"):
+                gen_loss_GAN = tf.reduce_mean(-tf.log(predict_fake + EPS))
+
+        else:
+            gen_loss_GAN = 0.0
+            predict_real=[]
+            predict_fake=[]
+            discrim_loss=[]
+
+        with tf.name_scope("generator_loss_L1"):
+            # predict_fake => 1
+            # abs(targets - outputs) => 0
+            gen_loss_L1 = tf.reduce_mean(tf.abs(inputs - outputs))      # !!!!!!!! targets
+
+        with tf.name_scope("generator_loss"):
+            gen_loss = gen_loss_L1 * a.l1_weight + gen_loss_GAN * a.gan_weight
+
+        return outputs, predict_real, predict_fake, discrim_loss, gen_loss_GAN, gen_loss_L1, gen_loss
+
+    if a.micro_batches > 1:
+        outputs, predict_real, predict_fake, discrim_loss, gen_loss_GAN, gen_loss_L1, discrim_grads_and_vars, gen_grads_and_vars = accumulate_gradients(create_losses, inputs, targets)
+    else:
+        (outputs, predict_real, predict_fake, discrim_loss, gen_loss_GAN, gen_loss_L1, gen_loss), moments = collect_moments(create_losses, inputs, targets)
+        update_moving_averages(moments)
+
+    if a.gan_weight: 
         with tf.name_scope("discriminator_train"):
-            discrim_tvars = [var for var in tf.trainable_variables() if var.name.startswith("discriminator")]
-            discrim_optim = tf.train.AdamOptimizer(a.lr, a.beta1)
-            discrim_grads_and_vars = discrim_optim.compute_gradients(discrim_loss, var_list=discrim_tvars)
+            discrim_optim = tf.train.AdamOptimizer(a.lr, a.beta1) if share is None else share.discrim_optim
+            if a.micro_batches == 1:
+                discrim_tvars = [var for var in tf.trainable_variables() if var.name.startswith("discriminator")]
+                discrim_grads_and_vars = discrim_optim.compute_gradients(discrim_loss, var_list=discrim_tvars)
             discrim_grads_and_vars = [(tf.clip_by_value(grad, -0.5, 0.5), var) for grad, var in discrim_grads_and_vars]
             discrim_train = [discrim_optim.apply_gradients(discrim_grads_and_vars)]
 
     else:
-        gen_loss_GAN = 0.0
+        discrim_optim = None
         discrim_grads_and_vars = []
         discrim_train = []
-        predict_real=[]
-        predict_fake=[]
-        discrim_loss=[]
-
-
-
-    with tf.name_scope("generator_loss_L1"):
-        # predict_fake => 1
-        # abs(targets - outputs) => 0
-        gen_loss_L1 = tf.reduce_mean(tf.abs(inputs - outputs))      # !!!!!!!! targets
-
-    with tf.name_scope("generator_loss"):
-        gen_loss = gen_loss_L1 * a.l1_weight + gen_loss_GAN * a.gan_weight
 
     
     with tf.name_scope("generator_train"):
-        with tf.control_dependencies(discrim_train):
+        gen_optim = tf.train.AdamOptimizer(a.lr, a.beta1) if share is None else share.gen_optim
+        #gen_optim = tf.train.RMSPropOptimizer(a.lr)
+        if a.micro_batches == 1:
+            # the gradients wait for the discriminator update through the gradient of the loss, ops in the
+            # gradient loops of the lstm models never run when they have a control input from outside the loop
+            with tf.control_dependencies(discrim_train):
+                grad_loss = tf.ones_like(gen_loss)
             gen_tvars = [var for var in tf.trainable_variables() if var.name.startswith("generator")]
-            gen_optim = tf.train.AdamOptimizer(a.lr, a.beta1)
-            #gen_optim = tf.train.RMSPropOptimizer(a.lr)
-            gen_grads_and_vars = gen_optim.compute_gradients(gen_loss, var_list=gen_tvars)            
+            gen_grads_and_vars = gen_optim.compute_gradients(gen_loss, var_list=gen_tvars, grad_loss=grad_loss)
+        with tf.control_dependencies(discrim_train):
             gen_grads_and_vars = [(tf.clip_by_value(grad, -0.5, 0.5), var) for grad, var in gen_grads_and_vars]
             gen_train = gen_optim.apply_gradients(gen_grads_and_vars)
             
@@ -491,10 +746,91 @@ def create_model(inputs, targets):
         gen_loss_L1=gen_loss_L1,
         gen_grads_and_vars=gen_grads_and_vars,
         outputs=outputs,
-        train=tf.group(incr_global_step, gen_train),
+        # only the batchnorm updates of this copy of the model
+        train=tf.group(incr_global_step, gen_train, *tf.get_collection(tf.GraphKeys.UPDATE_OPS)[update_ops_start:]),
+        discrim_optim=discrim_optim,
+        gen_optim=gen_optim,
     )
 
 
+def accumulate_gradients(create_losses, inputs, targets):
+    # runs the batch as --micro_batches equal parts one after another in a while loop, adding up the gradients,
+    # losses and batchnorm moments of the parts, so that only the activations of one part are in memory at a time
+    # the gradients are averaged before they are clipped, which gives the same update as the whole batch at once,
+    # except that batchnorm normalizes each part with the statistics of that part
+    parts = a.micro_batches
+    part_shape = [parts, a.batch_size // parts] + inputs.get_shape().as_list()[1:]
+    part_inputs = tf.reshape(inputs, part_shape)
+    part_targets = tf.reshape(targets, part_shape)
+
+    # the outputs and predictions for the whole batch, for summaries and display images, are only computed when they
+    # are fetched, this copy also creates the variables and has the same batchnorm layers in the same order as the parts
+    whole_batch, moments = collect_moments(create_losses, inputs, targets)
+    outputs, predict_real, predict_fake = whole_batch[:3]
+
+    discrim_tvars = [var for var in tf.trainable_variables() if var.name.startswith("discriminator")] if a.gan_weight else []
+    gen_tvars = [var for var in tf.trainable_variables() if var.name.startswith("generator")]
+
+    def body(i, loss_sums, grad_sums, moment_sums):
+        (_, _, _, discrim_loss, gen_loss_GAN, gen_loss_L1, gen_loss), part_moments = collect_moments(create_losses, part_inputs[i], part_targets[i])
+
+        losses = [gen_loss_L1]
+        grads = []
+        if a.gan_weight:
+            losses += [discrim_loss, gen_loss_GAN]
+            grads += tf.gradients(discrim_loss, discrim_tvars)
+        grads += tf.gradients(gen_loss, gen_tvars)
+        # the variance of the whole batch is the mean of E[x^2] over the parts minus the square of the mean
+        part_moments = [tf.stack([mean, variance + tf.square(mean)]) for _, _, _, mean, variance in part_moments]
+        return (
+            i + 1,
+            [total + loss for total, loss in zip(loss_sums, losses)],
+            [total + tf.convert_to_tensor(grad) for total, grad in zip(grad_sums, grads)],
+            [total + moment for total, moment in zip(moment_sums, part_moments)],
+        )
+
+    with tf.name_scope("micro_batches"), tf.variable_scope(tf.get_variable_scope(), reuse=True):
+        loop_vars = [
+            tf.constant(0),
+            [tf.constant(0.0)] * (3 if a.gan_weight else 1),
+            [tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype) for var in discrim_tvars + gen_tvars],
+            [tf.zeros([2] + mean.get_shape().as_list()) for _, _, _, mean, _ in moments],
+        ]
+        _, loss_sums, grad_sums, moment_sums = tf.while_loop(lambda i, loss_sums, grad_sums, moment_sums: i < parts, body, loop_vars, parallel_iterations=1)
+
+        # one moving average update with the moments of the whole batch, like a single batch would have
+        batch_moments = []
+        for (moving_mean, moving_variance, decay, _, _), total in zip(moments, moment_sums):
+            mean = total[0] / parts
+            batch_moments.append((moving_mean, moving_variance, decay, mean, total[1] / parts - tf.square(mean)))
+        update_moving_averages(batch_moments)
+
+        losses = [total / parts for total in loss_sums]
+        grads = [total / parts for total in grad_sums]
+
+    gen_loss_L1 = losses[0]
+    discrim_loss, gen_loss_GAN = losses[1:] if a.gan_weight else ([], 0.0)
+    discrim_grads_and_vars = list(zip(grads[:len(discrim_tvars)], discrim_tvars))
+    gen_grads_and_vars = list(zip(grads[len(discrim_tvars):], gen_tvars))
+    return outputs, predict_real, predict_fake, discrim_loss, gen_loss_GAN, gen_loss_L1, discrim_grads_and_vars, gen_grads_and_vars
+
+
+def create_train_loop(examples, model):
+    # runs a number of training steps in a single session.run, each on a new batch from the input queue,
+    # which saves the python overhead of a session.run per step
+    steps = tf.placeholder(tf.int32, shape=[], name="steps")
+
+    def body(i, _):
+        _, inputs, targets = examples.next_batch()
+        step_model = create_model(inputs, targets, share=model)
+        with tf.control_dependencies([step_model.train]):
+            return i + 1, tf.identity(step_model.gen_loss_L1)
+
+    with tf.name_scope("train_loop"), tf.variable_scope(tf.get_variable_scope(), reuse=True):
+        _, gen_loss_L1 = tf.while_loop(lambda i, _: i < steps, body, [tf.constant(0), tf.constant(0.0)], parallel_iterations=1)
+    return steps, gen_loss_L1
+
+
 def save_images(fetches, step=None):
     image_dir = os.path.join(a.output_dir, "images")
     if not os.path.exists(image_dir):
@@ -539,13 +875,438 @@ def append_index(filesets, step=False):
             index.write("<td><img src='images/%s'></td>" % fileset[kind])
 
         index.write("</tr>")
+    index.close()
     return index_path
 
 
+class DisplayWriter(object):
+    # encodes and writes training display images from a background thread, so that display steps only
+    # need to fetch the raw images
+    def __init__(self, sess, encode_input, encode_output):
+        self.sess = sess
+        self.encode_input = encode_input
+        self.encode_output = encode_output
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add_images(self, images, step):
+        self.queue.put((images, step))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            images, step = item
+            fetches = {"paths": images["paths"]}
+            for kind in ["inputs", "outputs", "targets"]:
+                fetches[kind] = [self.sess.run(self.encode_output, feed_dict={self.encode_input: image}) for image in images[kind]]
+            filesets = save_images(fetches, step=step)
+            append_index(filesets, step=True)
+
+
+class Checkpointer(object):
+    # saves checkpoints to output_dir, either inline or from a background thread, and records how long
+    # training was blocked by each save
+    def __init__(self, summary_writer=None):
+        self.summary_writer = summary_writer
+        self.variables = tf.global_variables()
+        self.saver = tf.train.Saver(max_to_keep=a.max_to_keep, keep_checkpoint_every_n_hours=a.keep_checkpoint_every_n_hours)
+        self.best = []
+        self.error = None
+        self.last_step = None
+        if a.async_save:
+            # a copy of the variables in a graph of its own, so that checkpoints can be written from
+            # the copy with the same names while training continues to change the originals
+            self.graph = tf.Graph()
+            with self.graph.as_default():
+                self.placeholders = []
+                copies = []
+                assigns = []
+                for var in self.variables:
+                    copy = tf.Variable(tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype), name=var.op.name, trainable=False)
+                    placeholder = tf.placeholder(var.dtype.base_dtype, shape=var.get_shape())
+                    copies.append(copy)
+                    assigns.append(tf.assign(copy, placeholder))
+                    self.placeholders.append(placeholder)
+                self.assign = tf.group(*assigns)
+                self.copy_saver = tf.train.Saver(copies, max_to_keep=a.max_to_keep, keep_checkpoint_every_n_hours=a.keep_checkpoint_every_n_hours)
+            self.copy_session = tf.Session(graph=self.graph)
+            # at most one checkpoint waiting to be written, after that saving blocks until the writer catches up
+            self.queue = queue.Queue(maxsize=1)
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def save(self, sess, step, gen_loss_L1=None):
+        if self.error is not None:
+            raise self.error
+
+        start = time.time()
+        if a.async_save:
+            values = sess.run(self.variables)
+            self.queue.put((values, step, gen_loss_L1))
+        else:
+            self._write(sess, self.saver, step, gen_loss_L1)
+        blocked = time.time() - start
+        self.last_step = step
+
+        print("saving model at step %d, blocked training for %0.2fs" % (step, blocked))
+        if self.summary_writer is not None:
+            summary = tf.Summary(value=[tf.Summary.Value(tag="checkpoint/blocked_secs", simple_value=blocked)])
+            self.summary_writer.add_summary(summary, step)
+
+    def close(self, timeout=None):
+        # returns False if the checkpoints were not all written within timeout seconds
+        deadline = None if timeout is None else time.time() + timeout
+        if a.async_save:
+            try:
+                self.queue.put(None, timeout=timeout)
+            except queue.Full:
+                return False
+            self.thread.join(None if deadline is None else max(deadline - time.time(), 0))
+            if self.thread.is_alive():
+                return False
+            self.copy_session.close()
+        if self.error is not None:
+            raise self.error
+        return True
+
+    def save_before_stop(self, sess, step, timeout):
+        # save from another thread so that a slow disk cannot hold up the shutdown for longer than timeout
+        deadline = time.time() + timeout
+        if self.last_step != step:
+            thread = threading.Thread(target=self.save, args=(sess, step))
+            thread.daemon = True
+            thread.start()
+            thread.join(timeout)
+            if thread.is_alive():
+                return False
+        return self.close(max(deadline - time.time(), 0))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            values, step, gen_loss_L1 = item
+            try:
+                self.copy_session.run(self.assign, feed_dict=dict(zip(self.placeholders, values)))
+                self._write(self.copy_session, self.copy_saver, step, gen_loss_L1)
+            except Exception as e:
+                self.error = e
+
+    def _write(self, sess, saver, step, gen_loss_L1):
+        path = saver.save(sess, os.path.join(a.output_dir, "model"), global_step=step, write_meta_graph=not a.async_save)
+        if a.keep_best > 0 and gen_loss_L1 is not None:
+            self._keep_best(path, step, gen_loss_L1)
+
+    def _keep_best(self, path, step, gen_loss_L1):
+        best_dir = os.path.join(a.output_dir, "best")
+        if not os.path.exists(best_dir):
+            os.makedirs(best_dir)
+
+        self.best.append((gen_loss_L1, step))
+        self.best.sort()
+        for _, removed_step in self.best[a.keep_best:]:
+            for filename in glob.glob(os.path.join(best_dir, "model-%d.*" % removed_step)):
+                os.remove(filename)
+        self.best = self.best[:a.keep_best]
+
+        if (gen_loss_L1, step) in self.best:
+            for filename in glob.glob(path + ".*"):
+                shutil.copy(filename, best_dir)
+            # --checkpoint output_dir/best restores the checkpoint with the lowest loss
+            paths = [os.path.join(best_dir, "model-%d" % best_step) for _, best_step in self.best]
+            tf.train.update_checkpoint_state(best_dir, paths[0], all_model_checkpoint_paths=paths)
+
+
+stop_requested = threading.Event()
+
+def request_stop(signum, frame):
+    # preemptible machines get a SIGTERM shortly before they are shut down
+    print("received signal %d, saving model after the current step" % signum), sys.stdout.flush()
+    stop_requested.set()
+
+
+class SummaryWriter(object):
+    # parses and writes summaries from a background thread so that the training loop does not wait for them
+    def __init__(self, writer):
+        self.writer = writer
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add_summary(self, summary, step):
+        self.queue.put((summary, step))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.flush()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self.writer.add_summary(*item)
+
+
+class Telemetry(object):
+    # writes one json object per training run to telemetry.jsonl and keeps the latest one for the metrics endpoint
+    def __init__(self):
+        self.file = open(os.path.join(a.output_dir, "telemetry.jsonl"), "a")
+        self.latest = {}
+        self.totals = collections.defaultdict(float)
+        self.lock = threading.Lock()
+        if a.metrics_port > 0:
+            telemetry = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path != "/metrics":
+                        self.send_response(404)
+                        self.end_headers()
+                        return
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain")
+                    self.end_headers()
+                    self.wfile.write(telemetry.metrics().encode("utf8"))
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.server = HTTPServer(("127.0.0.1", a.metrics_port), Handler)
+            thread = threading.Thread(target=self.server.serve_forever)
+            thread.daemon = True
+            thread.start()
+
+    def record(self, values):
+        values["time"] = time.time()
+        self.file.write(json.dumps(values) + "\n")
+        with self.lock:
+            self.latest = values
+            for key, value in values.items():
+                if key not in ["step", "time", "queue_size"]:
+                    self.totals[key] += value
+
+    def metrics(self):
+        lines = []
+        with self.lock:
+            for key, value in sorted(self.latest.items()):
+                lines.append("pix2pix_%s %s" % (key, value))
+            for key, value in sorted(self.totals.items()):
+                lines.append("pix2pix_%s_total %s" % (key, value))
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        self.file.close()
+        if a.metrics_port > 0:
+            self.server.shutdown()
+
+
+def load_profile(section):
+    # settings written by tools/autotune.py, options given on the command line take precedence
+    path = os.environ.get("PIX2PIX_PROFILE", os.path.expanduser(os.path.join("~", ".pix2pix", "profile.json")))
+    if not os.path.exists(path):
+        return
+    with open(path) as f:
+        profile = json.loads(f.read()).get(section, {})
+    for key, val in profile.items():
+        if any(arg == "--" + key or arg.startswith("--" + key + "=") for arg in sys.argv[1:]):
+            continue
+        print("loaded", key, "=", val, "from", path)
+        setattr(a, key, val)
+
+
+def session_config():
+    return tf.ConfigProto(intra_op_parallelism_threads=a.intra_op_threads, inter_op_parallelism_threads=a.inter_op_threads)
+
+
+def benchmark():
+    # time the model on random inputs of the same size as the training data, for tools/benchmark.py
+    import resource
+
+    # variables rather than placeholders so that feeding the inputs is not part of the timing
+    inputs = tf.Variable(tf.random_uniform([a.batch_size, IMAGE_HEIGHT, IMAGE_WIDTH], -1, 1), trainable=False, name="benchmark_inputs")
+    targets = tf.Variable(tf.random_uniform([a.batch_size, IMAGE_HEIGHT, IMAGE_WIDTH], -1, 1), trainable=False, name="benchmark_targets")
+    model = create_model(inputs, targets)
+
+    grads = [grad for grad, _ in model.discrim_grads_and_vars + model.gen_grads_and_vars]
+    parts = [
+        ("generator_forward", tf.group(model.outputs)),
+        ("forward_backward", tf.group(*grads)),
+        ("train", model.train),
+    ]
+    if a.gan_weight:
+        parts.insert(1, ("discriminator_forward", tf.group(model.predict_real, model.predict_fake)))
+
+    with tf.name_scope("parameter_count"):
+        parameter_count = tf.reduce_sum([tf.reduce_prod(tf.shape(v)) for v in tf.trainable_variables()])
+
+    results = {"parameter_count": 0}
+    with tf.Session(config=session_config()) as sess:
+        sess.run(tf.global_variables_initializer())
+        results["parameter_count"] = int(sess.run(parameter_count))
+        for name, op in parts:
+            # the first runs are slower while tensorflow allocates memory and picks algorithms
+            for _ in range(3):
+                sess.run(op)
+            start = time.time()
+            for _ in range(a.benchmark_steps):
+                sess.run(op)
+            elapsed = time.time() - start
+            results[name] = a.batch_size * a.benchmark_steps / elapsed
+            print("%-22s %0.1f images/sec  %0.1fms/step" % (name, results[name], elapsed / a.benchmark_steps * 1000))
+
+    # kilobytes on linux, bytes on mac
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results["peak_memory_mb"] = maxrss / 1024 / (1024 if sys.platform == "darwin" else 1)
+    print("peak memory %dMB" % results["peak_memory_mb"])
+
+    with open(os.path.join(a.output_dir, "benchmark.json"), "w") as f:
+        f.write(json.dumps(results, sort_keys=True, indent=4))
+
+
+def window_starts(width):
+    starts = list(range(0, max(width - IMAGE_WIDTH, 0) + 1, a.stream_stride))
+    if starts[-1] + IMAGE_WIDTH < width:
+        starts.append(width - IMAGE_WIDTH)
+    return starts
+
+
+def stream_image(read_columns, write_columns, width, run_windows):
+    # run the generator over overlapping windows of a [height, width] image in batches, reading and
+    # writing a few columns at a time so that memory use does not depend on the width of the image
+    # overlapping windows are blended with triangular weights so that the seams fade into each other
+    column = np.arange(IMAGE_WIDTH)
+    weights = np.minimum(column + 1, IMAGE_WIDTH - column).astype(np.float32)
+
+    starts = window_starts(width)
+    # columns before written have been sent to write_columns, acc and norm hold the columns after that
+    written = 0
+    acc = np.zeros([IMAGE_HEIGHT, 0], dtype=np.float32)
+    norm = np.zeros([0], dtype=np.float32)
+    for batch_start in range(0, len(starts), a.batch_size):
+        batch_starts = starts[batch_start:batch_start + a.batch_size]
+        windows = np.zeros([len(batch_starts), IMAGE_HEIGHT, IMAGE_WIDTH], dtype=np.uint8)
+        for i, start in enumerate(batch_starts):
+            columns = read_columns(start, min(start + IMAGE_WIDTH, width))
+            windows[i, :, :columns.shape[1]] = columns
+        outputs = run_windows(windows)
+
+        end = min(batch_starts[-1] + IMAGE_WIDTH, width)
+        if end - written > acc.shape[1]:
+            grow = end - written - acc.shape[1]
+            acc = np.concatenate([acc, np.zeros([IMAGE_HEIGHT, grow], dtype=np.float32)], axis=1)
+            norm = np.concatenate([norm, np.zeros([grow], dtype=np.float32)])
+
+        for start, output in zip(batch_starts, outputs):
+            count = min(IMAGE_WIDTH, width - start)
+            acc[:, start - written:start - written + count] += output[:, :count] * weights[:count]
+            norm[start - written:start - written + count] += weights[:count]
+
+        # no later window overlaps the columns before the next window start
+        if batch_start + a.batch_size < len(starts):
+            done = starts[batch_start + a.batch_size]
+        else:
+            done = width
+        blended = acc[:, :done - written] / norm[:done - written]
+        write_columns(written, np.clip(np.round(blended), 0, 255).astype(np.uint8))
+        acc = acc[:, done - written:]
+        norm = norm[done - written:]
+        written = done
+
+
+def stream():
+    if a.input_dir is None or not os.path.exists(a.input_dir):
+        raise Exception("input_dir does not exist")
+
+    if a.stream_stride < 1 or a.stream_stride > IMAGE_WIDTH:
+        raise Exception("stream_stride must be between 1 and %d" % IMAGE_WIDTH)
+
+    input_paths = sorted(glob.glob(os.path.join(a.input_dir, "*.png")) + glob.glob(os.path.join(a.input_dir, "*.npy")))
+    if len(input_paths) == 0:
+        raise Exception("input_dir contains no image files")
+
+    if os.path.exists(os.path.join(a.checkpoint, "export.meta")):
+        # use the windows signature of an exported model
+        saver = tf.train.import_meta_graph(os.path.join(a.checkpoint, "export.meta"))
+        restore = lambda sess: saver.restore(sess, os.path.join(a.checkpoint, "export"))
+        windows_vars = json.loads(tf.get_collection("windows")[0])
+        windows_input = tf.get_default_graph().get_tensor_by_name(windows_vars["input"])
+        windows_output = tf.get_default_graph().get_tensor_by_name(windows_vars["output"])
+    else:
+        windows_input = tf.placeholder(tf.uint8, shape=[None, IMAGE_HEIGHT, IMAGE_WIDTH])
+        windows_output = create_uint8_generator(windows_input)
+        restore = restorer(tf.train.latest_checkpoint(a.checkpoint))
+
+    with tf.name_scope("stream_png"):
+        png_input = tf.placeholder(tf.string, shape=[])
+        decoded = tf.image.decode_png(png_input, channels=1)[:, :, 0]
+        pixels = tf.placeholder(tf.uint8, shape=[None, None])
+        png_output = tf.image.encode_png(tf.expand_dims(pixels, -1))
+
+    with tf.Session(config=session_config()) as sess:
+        print("loading model from checkpoint")
+        restore(sess)
+
+        run_windows = lambda windows: sess.run(windows_output, feed_dict={windows_input: windows})
+
+        for input_path in input_paths:
+            start = time.time()
+            name, ext = os.path.splitext(os.path.basename(input_path))
+            if ext == ".npy":
+                # [height, width] uint8 arrays are read and written column by column through memory maps
+                input = np.load(input_path, mmap_mode="r")
+                output = np.lib.format.open_memmap(os.path.join(a.output_dir, name + ".npy"), mode="w+", dtype=np.uint8, shape=input.shape)
+            else:
+                # png files have to be decoded and encoded in one piece
+                with open(input_path, "rb") as f:
+                    input = sess.run(decoded, feed_dict={png_input: f.read()})
+                output = np.zeros(input.shape, dtype=np.uint8)
+
+            if input.shape[0] != IMAGE_HEIGHT:
+                raise Exception("image does not have height %d" % IMAGE_HEIGHT)
+
+            width = input.shape[1]
+
+            def write_columns(start, columns):
+                output[:, start:start + columns.shape[1]] = columns
+
+            stream_image(lambda start, end: np.asarray(input[:, start:end]), write_columns, width, run_windows)
+
+            if ext == ".npy":
+                output.flush()
+                del output
+            else:
+                with open(os.path.join(a.output_dir, name + ".png"), "wb") as f:
+                    f.write(sess.run(png_output, feed_dict={pixels: output}))
+
+            print("streamed %s  %d columns  %0.1f columns/sec" % (name, width, width / (time.time() - start)))
+
+
 def main():
     if tf.__version__.split('.')[0] != "1":
         raise Exception("Tensorflow version 1 required")
 
+    if a.mode == "train":
+        load_profile("train")
+
+    if a.micro_batches < 1:
+        raise Exception("micro_batches must be at least 1")
+
+    if a.batch_size % a.micro_batches != 0:
+        raise Exception("batch_size must be a multiple of micro_batches")
+
     if a.seed is None:
         a.seed = random.randint(0, 2**31 - 1)
 
@@ -561,7 +1322,7 @@ def main():
             raise Exception("checkpoint required for test mode")
 
         # load some options from the checkpoint
-        options = {"which_direction", "ngf", "ndf"}
+        options = {"which_direction", "ngf", "ndf", "convolution", "lstm"}
         with open(os.path.join(a.checkpoint, "options.json")) as f:
             for key, val in json.loads(f.read()).items():
                 if key in options:
@@ -576,18 +1337,18 @@ def main():
 
     if a.mode == "export":
         # export the generator to a meta graph that can be imported later for standalone generation
-        CROP_SIZE = 256
         input = tf.placeholder(tf.string, shape=[1])
         input_data = tf.decode_base64(input[0])
-        input_image = tf.image.decode_png(input_data)
+        input_image = tf.image.decode_png(input_data, channels=1)
         input_image = tf.image.convert_image_dtype(input_image, dtype=tf.float32)
-        input_image.set_shape([CROP_SIZE, CROP_SIZE, 3])
-        batch_input = tf.expand_dims(input_image, axis=0)
+        input_image.set_shape([IMAGE_HEIGHT, IMAGE_WIDTH, 1])
+        # [height, width, 1] => [1, height, width]
+        batch_input = tf.expand_dims(input_image[:, :, 0], axis=0)
 
         with tf.variable_scope("generator"):
-            batch_output = deprocess(create_generator(preprocess(batch_input), 3))
+            batch_output = deprocess(create_generator(preprocess(batch_input), training=False))
 
-        output_image = tf.image.convert_image_dtype(batch_output, dtype=tf.uint8)[0]
+        output_image = tf.image.convert_image_dtype(tf.expand_dims(batch_output[0], -1), dtype=tf.uint8, saturate=True)
         if a.output_filetype == "png":
             output_data = tf.image.encode_png(output_image)
         elif a.output_filetype == "jpeg":
@@ -608,27 +1369,72 @@ def main():
         }
         tf.add_to_collection("outputs", json.dumps(outputs))
 
+        if a.convolution:
+            # the convolution generator can be run on tiles of any width (a multiple of the total stride)
+            # which lets server/serve.py recompute only the part of the output affected by an edit
+            with tf.name_scope("tiles"):
+                png_input = tf.placeholder(tf.string, shape=[])
+                pixels = tf.image.decode_png(png_input, channels=1)[:, :, 0]
+                tile_input = tf.placeholder(tf.uint8, shape=[1, IMAGE_HEIGHT, None])
+                pixels_input = tf.placeholder(tf.uint8, shape=[None, None])
+                png_output = tf.image.encode_png(tf.expand_dims(pixels_input, -1))
+
+            tile_output = create_uint8_generator(tile_input, reuse=True)
+
+            tiles = {
+                "png_input": png_input.name,
+                "pixels": pixels.name,
+                "input": tile_input.name,
+                "output": tile_output.name,
+                "pixels_input": pixels_input.name,
+                "png_output": png_output.name,
+                "layers": generator_layers(),
+            }
+            tf.add_to_collection("tiles", json.dumps(tiles))
+
+        # fixed size windows for --stream
+        windows_input = tf.placeholder(tf.uint8, shape=[None, IMAGE_HEIGHT, IMAGE_WIDTH])
+        windows = {
+            "input": windows_input.name,
+            "output": create_uint8_generator(windows_input, reuse=True).name,
+        }
+        tf.add_to_collection("windows", json.dumps(windows))
+
         init_op = tf.global_variables_initializer()
-        restore_saver = tf.train.Saver()
+        restore = restorer(tf.train.latest_checkpoint(a.checkpoint))
         export_saver = tf.train.Saver()
 
-        with tf.Session() as sess:
+        with tf.Session(config=session_config()) as sess:
             sess.run(init_op)
             print("loading model from checkpoint")
-            checkpoint = tf.train.latest_checkpoint(a.checkpoint)
-            restore_saver.restore(sess, checkpoint)
+            restore(sess)
             print("exporting model")
             export_saver.export_meta_graph(filename=os.path.join(a.output_dir, "export.meta"))
             export_saver.save(sess, os.path.join(a.output_dir, "export"), write_meta_graph=False)
 
         return
 
+    if a.mode == "benchmark":
+        benchmark()
+        return
+
+    if a.mode == "test" and a.stream:
+        stream()
+        return
+
     examples = load_examples()
     print("examples count = %d" % examples.count)
         
 
     # inputs and targets are [batch_size, height, width, channels]
-    model = create_model(examples.inputs, examples.targets)
+    training = True
+    if a.mode == "test":
+        # normalize with the batchnorm moving averages like export and --stream, checkpoints from before
+        # they were kept can only be tested with the statistics of each batch
+        training = not has_moving_averages(tf.train.latest_checkpoint(a.checkpoint))
+        if training:
+            print("warning: checkpoint has no batchnorm moving averages, normalizing with the statistics of each batch")
+    model = create_model(examples.inputs, examples.targets, training=training)
     inputs = deprocess(examples.inputs)
     targets = deprocess(examples.targets)
     outputs = deprocess(model.outputs)
@@ -646,6 +1452,18 @@ def main():
     with tf.name_scope("convert_outputs"):
         converted_outputs = convert(outputs)
 
+    with tf.name_scope("display_images"):
+        # raw images for DisplayWriter to encode away from the training step
+        display_count = a.batch_size if a.display_count == 0 else min(a.display_count, a.batch_size)
+        display_images = {
+            "paths": examples.paths[:display_count],
+            "inputs": converted_inputs[:display_count],
+            "targets": converted_targets[:display_count],
+            "outputs": converted_outputs[:display_count],
+        }
+        encode_input = tf.placeholder(tf.uint8, shape=[None, None, 1])
+        encode_output = tf.image.encode_png(encode_input)
+
     with tf.name_scope("encode_images"):
         display_fetches = {
             "paths": examples.paths,
@@ -654,15 +1472,20 @@ def main():
             "outputs": tf.map_fn(tf.image.encode_png, converted_outputs, dtype=tf.string, name="output_pngs"),
         }
 
-    # summaries
+    # summaries, scalars are cheap and recorded every summary_freq steps, histograms and images
+    # are recorded every histogram_freq steps
+    if a.histogram_freq is None:
+        a.histogram_freq = a.summary_freq
+    detail_summaries = ["detail_summaries"]
+
     with tf.name_scope("inputs_summary"):
-        tf.summary.image("inputs", converted_inputs)
+        tf.summary.image("inputs", converted_inputs, collections=detail_summaries)
 
     with tf.name_scope("targets_summary"):
-        tf.summary.image("targets", converted_targets)
+        tf.summary.image("targets", converted_targets, collections=detail_summaries)
 
     with tf.name_scope("outputs_summary"):
-        tf.summary.image("outputs", converted_outputs)
+        tf.summary.image("outputs", converted_outputs, collections=detail_summaries)
 
     #with tf.name_scope("predict_real_summary"):
     #    tf.summary.image("predict_real", convert(model.predict_real, saturate=False))
@@ -674,26 +1497,44 @@ def main():
     #tf.summary.scalar("generator_loss_GAN", model.gen_loss_GAN)
     tf.summary.scalar("generator_loss_L1", model.gen_loss_L1)
 
-    for var in tf.trainable_variables():
-        tf.summary.histogram(var.op.name + "/values", var)
+    histogram_vars = tf.trainable_variables()
+    if a.histogram_vars > 0 and a.histogram_vars < len(histogram_vars):
+        histogram_vars = random.Random(a.seed).sample(histogram_vars, a.histogram_vars)
+
+    for var in histogram_vars:
+        tf.summary.histogram(var.op.name + "/values", var, collections=detail_summaries)
 
     for grad, var in model.discrim_grads_and_vars + model.gen_grads_and_vars:
-        tf.summary.histogram(var.op.name + "/gradients", grad)
+        if var in histogram_vars:
+            tf.summary.histogram(var.op.name + "/gradients", grad, collections=detail_summaries)
+
+    summary_op = tf.summary.merge_all()
+    detail_summary_op = tf.summary.merge_all(key=detail_summaries[0])
 
     with tf.name_scope("parameter_count"):
         parameter_count = tf.reduce_sum([tf.reduce_prod(tf.shape(v)) for v in tf.trainable_variables()])
 
-    saver = tf.train.Saver(max_to_keep=1)
-
-    logdir = a.output_dir if (a.trace_freq > 0 or a.summary_freq > 0) else None
-    sv = tf.train.Supervisor(logdir=logdir, save_summaries_secs=0, saver=None)
-    with sv.managed_session() as sess:
+    if a.mode == "train" and a.steps_per_run > 1:
+        train_loop_steps, train_loop = create_train_loop(examples, model)
+
+    if a.checkpoint is not None:
+        restore = restorer(tf.train.latest_checkpoint(a.checkpoint))
+    if a.mode == "train":
+        checkpointer = Checkpointer()
+        signal.signal(signal.SIGTERM, request_stop)
+
+    logdir = a.output_dir if (a.trace_freq > 0 or a.summary_freq > 0 or a.histogram_freq > 0) else None
+    sv = tf.train.Supervisor(logdir=logdir, save_summaries_secs=0, saver=None, summary_op=None)
+    summary_writer = None
+    if a.mode == "train" and sv.summary_writer is not None:
+        summary_writer = SummaryWriter(sv.summary_writer)
+        checkpointer.summary_writer = summary_writer
+    with sv.managed_session(config=session_config()) as sess:
         print("parameter_count =", sess.run(parameter_count))
 
         if a.checkpoint is not None:
             print("loading model from checkpoint")
-            checkpoint = tf.train.latest_checkpoint(a.checkpoint)
-            saver.restore(sess, checkpoint)
+            restore(sess)
 
         max_steps = 2**32
         if a.max_epochs is not None:
@@ -716,10 +1557,46 @@ def main():
         else:
             # training
             start = time.time()
+            last_save = start
+
+            def should_at(freq, step):
+                return freq > 0 and ((step + 1) % freq == 0 or step == max_steps - 1)
+
+            def should_save(step):
+                return should_at(a.save_freq, step) or (a.save_secs > 0 and time.time() - last_save >= a.save_secs)
+
+            def fetches_anything(step):
+                return should_save(step) or any(should_at(freq, step) for freq in [a.trace_freq, a.progress_freq, a.summary_freq, a.histogram_freq, a.display_freq])
+
+            display_writer = DisplayWriter(sess, encode_input, encode_output)
+            telemetry = Telemetry() if a.telemetry else None
+            progress = tqdm(total=max_steps)
+            step = 0
+            while step < max_steps:
+                if a.steps_per_run > 1:
+                    # steps that do not fetch anything are run in the graph, up to steps_per_run at a time
+                    count = 0
+                    while count < a.steps_per_run and step + count < max_steps and not fetches_anything(step + count):
+                        count += 1
+                    if count > 0:
+                        if telemetry is not None:
+                            queue_size = sess.run(examples.queue_size)
+                            run_start = time.time()
+                        sess.run(train_loop, feed_dict={train_loop_steps: count})
+                        if telemetry is not None:
+                            # the queue wait is part of the run for steps in the graph
+                            telemetry.record({"step": step + count, "steps": count, "run": time.time() - run_start, "queue_size": int(queue_size)})
+                        step += count
+                        progress.update(count)
+                        if sv.should_stop() or stop_requested.is_set():
+                            print("terminating"), sys.stdout.flush()
+                            break
+                        continue
 
-            for step in tqdm(range(max_steps)):
                 def should(freq):
-                    return freq > 0 and ((step + 1) % freq == 0 or step == max_steps - 1)
+                    return should_at(freq, step)
+
+                save = should_save(step)
 
                 options = None
                 run_metadata = None
@@ -738,28 +1615,59 @@ def main():
                     #fetches["gen_loss_GAN"] = model.gen_loss_GAN
                     fetches["gen_loss_L1"] = model.gen_loss_L1
 
+                if save and a.keep_best > 0:
+                    fetches["gen_loss_L1"] = model.gen_loss_L1
+
                 if should(a.summary_freq):
                     print("fetching summary"), sys.stdout.flush()
-                    fetches["summary"] = sv.summary_op
+                    fetches["summary"] = summary_op
+
+                if should(a.histogram_freq):
+                    print("fetching histograms"), sys.stdout.flush()
+                    fetches["detail_summary"] = detail_summary_op
 
                 if should(a.display_freq):
                     print("fetching display"), sys.stdout.flush()
-                    fetches["display"] = display_fetches
+                    fetches["display"] = display_images
+
+                if telemetry is not None:
+                    fetches["queue_size"] = examples.queue_size
+                    fetches["queue_wait"] = examples.queue_wait
+                    mark = time.time()
 
                 results = sess.run(fetches, options=options, run_metadata=run_metadata)
 
+                if telemetry is not None:
+                    # the time the dequeue in the step waited for the input queue is not counted as running the step
+                    queue_wait = float(results["queue_wait"])
+                    timings = {"step": step + 1, "queue_size": int(results["queue_size"]), "queue_wait": queue_wait, "run": time.time() - mark - queue_wait}
+                    mark = time.time()
+
                 if should(a.summary_freq):
                     print("recording summary"), sys.stdout.flush()
-                    sv.summary_writer.add_summary(results["summary"], results["global_step"])
+                    summary_writer.add_summary(results["summary"], results["global_step"])
+
+                if should(a.histogram_freq):
+                    summary_writer.add_summary(results["detail_summary"], results["global_step"])
+
+                if telemetry is not None:
+                    timings["summary"] = time.time() - mark
+                    mark = time.time()
 
                 if should(a.display_freq):
                     print("saving display images"), sys.stdout.flush()
-                    filesets = save_images(results["display"], step=results["global_step"])
-                    append_index(filesets, step=True)
+                    display_writer.add_images(results["display"], results["global_step"])
+
+                if telemetry is not None:
+                    timings["display"] = time.time() - mark
 
                 if should(a.trace_freq):
                     print("recording trace"), sys.stdout.flush()
                     sv.summary_writer.add_run_metadata(run_metadata, "step_%d" % results["global_step"])
+                    # chrome://tracing timeline for tools/trace-report.py
+                    trace = timeline.Timeline(run_metadata.step_stats)
+                    with open(os.path.join(a.output_dir, "timeline-%08d.json" % results["global_step"]), "w") as f:
+                        f.write(trace.generate_chrome_trace_format())
 
                 if should(a.progress_freq):
                     print("printing progress trace"), sys.stdout.flush()
@@ -773,13 +1681,39 @@ def main():
                     #print("gen_loss_GAN", results["gen_loss_GAN"])
                     print("gen_loss_L1", results["gen_loss_L1"])
 
-                if should(a.save_freq):
-                    print("saving model")
-                    saver.save(sess, os.path.join(a.output_dir, "model"), global_step=sv.global_step)
+                if save:
+                    mark = time.time()
+                    checkpointer.save(sess, sess.run(sv.global_step), results.get("gen_loss_L1"))
+                    last_save = time.time()
+                    if telemetry is not None:
+                        timings["save"] = last_save - mark
+
+                if telemetry is not None:
+                    telemetry.record(timings)
 
-                if sv.should_stop():
+                step += 1
+                progress.update(1)
+
+                if sv.should_stop() or stop_requested.is_set():
                     print("terminating"), sys.stdout.flush()
                     break
 
+            progress.close()
+            display_writer.close()
+            if telemetry is not None:
+                telemetry.close()
+            if stop_requested.is_set():
+                # a resumed run continues from this global step
+                if not checkpointer.save_before_stop(sess, sess.run(sv.global_step), a.preemption_secs):
+                    print("final checkpoint was not written within %0.1fs" % a.preemption_secs)
+                if summary_writer is not None:
+                    summary_writer.close()
+                sv.request_stop()
+            else:
+                # wait for the last checkpoint to be written
+                checkpointer.close()
+                if summary_writer is not None:
+                    summary_writer.close()
+
 
 main()
@@ -3,6 +3,7 @@ from __future__ import division
 from __future__ import print_function
 
 import socket
+import sys
 import time
 import argparse
 import base64
@@ -12,6 +13,10 @@ import traceback
 import threading
 import multiprocessing
 import random
+import itertools
+import collections
+import struct
+import numpy as np
 
 
 # https://github.com/Nakiami/MultithreadedSimpleHTTPServer/blob/master/MultithreadedSimpleHTTPServer.py
@@ -33,10 +38,33 @@ parser.add_argument("--origin", help="allowed origin")
 parser.add_argument("--addr", default="", help="address to listen on")
 parser.add_argument("--port", default=8000, type=int, help="port to listen on")
 parser.add_argument("--wait", default=0, type=int, help="time to wait for each request")
+parser.add_argument("--incremental", action="store_true", help="for requests with an X-Session-Id, only recompute the part of the output affected by what changed since the previous request from that session (requires a model exported with --convolution)")
+parser.add_argument("--verify_incremental", action="store_true", help="also run the full model for each incremental request and print the largest difference")
+parser.add_argument("--max_sessions", default=1000, type=int, help="number of sessions to keep the previous input and output for with --incremental")
+parser.add_argument("--batch_size", default=32, type=int, help="number of images to run through the model at once for /<model>/batch requests")
+parser.add_argument("--intra_op_threads", default=0, type=int, help="number of threads to use within an op, 0 for the tensorflow default")
+parser.add_argument("--inter_op_threads", default=0, type=int, help="number of ops to run in parallel, 0 for the tensorflow default")
+parser.add_argument("--max_batch_body", default=256 * 1024 * 1024, type=int, help="largest request body in bytes to accept for /<model>/batch requests")
 parser.add_argument("--credentials", help="JSON credentials for a Google Cloud Platform service account, generate this at https://console.cloud.google.com/iam-admin/serviceaccounts/project (select \"Furnish a new private key\")")
 parser.add_argument("--project", help="Google Cloud Project to use, only necessary if using default application credentials")
 a = parser.parse_args()
 
+
+def load_profile(section):
+    # settings written by tools/autotune.py, options given on the command line take precedence
+    path = os.environ.get("PIX2PIX_PROFILE", os.path.expanduser(os.path.join("~", ".pix2pix", "profile.json")))
+    if not os.path.exists(path):
+        return
+    with open(path) as f:
+        profile = json.loads(f.read()).get(section, {})
+    for key, val in profile.items():
+        if any(arg == "--" + key or arg.startswith("--" + key + "=") for arg in sys.argv[1:]):
+            continue
+        print("loaded", key, "=", val, "from", path)
+        setattr(a, key, val)
+
+load_profile("serve")
+
 jobs = threading.Semaphore(multiprocessing.cpu_count() * 4)
 models = {}
 ml = None
@@ -76,10 +104,207 @@ class RateCounter(object):
             return sum(self.buckets)
 
 
+class SessionQueue(object):
+    """
+    serialize requests from the same editor session and drop any request that has been
+    superseded by a newer one from that session before it got a chance to run, so that
+    at most one request per session is ever waiting behind the one currently running
+    """
+    def __init__(self):
+        self.sessions = {}
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def acquire(self, session_id, seq=None):
+        # returns True if the caller should run the request, False if it was superseded
+        if seq is None:
+            # no sequence id from the client, use arrival order
+            seq = next(self.counter)
+
+        with self.lock:
+            if session_id not in self.sessions:
+                self.sessions[session_id] = dict(running=threading.Lock(), latest=seq, waiters=0)
+            session = self.sessions[session_id]
+            if seq < session["latest"]:
+                return False
+            session["latest"] = seq
+            session["waiters"] += 1
+
+        session["running"].acquire()
+
+        with self.lock:
+            if session["latest"] == seq:
+                return True
+            self._leave(session_id)
+        return False
+
+    def release(self, session_id):
+        with self.lock:
+            self._leave(session_id)
+
+    def _leave(self, session_id):
+        session = self.sessions[session_id]
+        session["running"].release()
+        session["waiters"] -= 1
+        if session["waiters"] == 0:
+            del self.sessions[session_id]
+
+
+class Tiling(object):
+    """
+    keeps track of which columns depend on which along the width of a fully convolutional
+    generator, layers are (filter_size, stride, transposed) with SAME padding
+    """
+    def __init__(self, layers):
+        self.layers = layers
+        # tiles must start and end on a multiple of this so every layer lines up with the full image
+        self.align = 1
+        for _filter_size, stride, transposed in layers:
+            if not transposed:
+                self.align *= stride
+
+    def sizes(self, width):
+        sizes = [width]
+        for _filter_size, stride, transposed in self.layers:
+            if transposed:
+                sizes.append(sizes[-1] * stride)
+            else:
+                sizes.append(sizes[-1] // stride)
+        return sizes
+
+    def _pad_before(self, in_size, filter_size, stride):
+        out_size = (in_size + stride - 1) // stride
+        return max((out_size - 1) * stride + filter_size - in_size, 0) // 2
+
+    def _sources(self, lo, hi, filter_size, stride, pad, size):
+        # range of conv inputs that the conv outputs lo..hi are computed from
+        return max(lo * stride - pad, 0), min(hi * stride - pad + filter_size - 1, size - 1)
+
+    def _sinks(self, lo, hi, filter_size, stride, pad, size):
+        # range of conv outputs that the conv inputs lo..hi contribute to
+        return max(-((filter_size - 1 - lo - pad) // stride), 0), min((hi + pad) // stride, size - 1)
+
+    def affected(self, lo, hi, width):
+        # range of output columns that changing input columns lo..hi (inclusive) can change
+        sizes = self.sizes(width)
+        for i, (filter_size, stride, transposed) in enumerate(self.layers):
+            if transposed:
+                pad = self._pad_before(sizes[i + 1], filter_size, stride)
+                lo, hi = self._sources(lo, hi, filter_size, stride, pad, sizes[i + 1])
+            else:
+                pad = self._pad_before(sizes[i], filter_size, stride)
+                lo, hi = self._sinks(lo, hi, filter_size, stride, pad, sizes[i + 1])
+        return lo, hi
+
+    def tile(self, lo, hi, width):
+        # input tile [start, end) that contains everything output columns lo..hi (inclusive) depend on
+        sizes = self.sizes(width)
+        start, end = lo * width // sizes[-1], (hi + 1) * width // sizes[-1]
+        for i in reversed(range(len(self.layers))):
+            filter_size, stride, transposed = self.layers[i]
+            if transposed:
+                pad = self._pad_before(sizes[i + 1], filter_size, stride)
+                lo, hi = self._sinks(lo, hi, filter_size, stride, pad, sizes[i])
+            else:
+                pad = self._pad_before(sizes[i], filter_size, stride)
+                lo, hi = self._sources(lo, hi, filter_size, stride, pad, sizes[i])
+            start = min(start, lo * width // sizes[i])
+            end = max(end, -(-(hi + 1) * width // sizes[i]))
+        start = start // self.align * self.align
+        end = min(-(-end // self.align) * self.align, width)
+        return start, end
+
+
 successes = RateCounter(1 * 60 * 1e6)
 failures = RateCounter(1 * 60 * 1e6)
 cloud_requests = RateCounter(5 * 60 * 1e6)
 cloud_accepts = RateCounter(5 * 60 * 1e6)
+superseded = RateCounter(1 * 60 * 1e6)
+session_queue = SessionQueue()
+session_cache = collections.OrderedDict()
+session_cache_lock = threading.Lock()
+
+
+def run_incremental(m, session_id, input_data):
+    # run the generator only on the columns that changed since the previous request from this session
+    # and stitch the result into the previous output
+    sess = m["sess"]
+    tiles = m["tiles"]
+    tiling = tiles["tiling"]
+    pixels = sess.run(tiles["pixels"], feed_dict={tiles["png_input"]: input_data})
+    height, width = pixels.shape
+
+    with session_cache_lock:
+        previous = session_cache.pop(session_id, None)
+
+    if previous is None or previous["input"].shape != pixels.shape or width % tiling.align != 0:
+        output = sess.run(tiles["output"], feed_dict={tiles["input"]: pixels[np.newaxis]})[0]
+    else:
+        output = previous["output"]
+        changed = np.nonzero(np.any(pixels != previous["input"], axis=0))[0]
+        if len(changed) > 0:
+            lo, hi = tiling.affected(changed[0], changed[-1], width)
+            start, end = tiling.tile(lo, hi, width)
+            tile_output = sess.run(tiles["output"], feed_dict={tiles["input"]: pixels[np.newaxis, :, start:end]})[0]
+            output = output.copy()
+            output[:, lo:hi + 1] = tile_output[:, lo - start:hi + 1 - start]
+            print("recomputed columns %d-%d using tile %d-%d of %d" % (lo, hi, start, end, width))
+
+        if a.verify_incremental:
+            full_output = sess.run(tiles["output"], feed_dict={tiles["input"]: pixels[np.newaxis]})[0]
+            print("incremental max difference %d" % np.max(np.abs(full_output.astype(np.int32) - output)))
+
+    with session_cache_lock:
+        session_cache[session_id] = dict(input=pixels, output=output)
+        while len(session_cache) > a.max_sessions:
+            session_cache.popitem(last=False)
+
+    return sess.run(tiles["png_output"], feed_dict={tiles["pixels_input"]: output})
+
+
+def run_batch(b, inputs):
+    # decode each image separately so that one bad image does not fail the rest
+    images = []
+    for input_data in inputs:
+        try:
+            images.append(b["sess"].run(b["pixels"], feed_dict={b["png_input"]: input_data}))
+        except Exception:
+            print("exception while decoding batch image", traceback.format_exc())
+            images.append(None)
+
+    valid = [image for image in images if image is not None and image.shape == b["shape"]]
+    encoded = iter([])
+    if len(valid) > 0:
+        encoded = iter(b["sess"].run(b["output"], feed_dict={b["input"]: np.stack(valid)}))
+
+    outputs = []
+    for image in images:
+        if image is not None and image.shape == b["shape"]:
+            outputs.append(next(encoded))
+        else:
+            outputs.append(b"")
+    return outputs
+
+
+def parse_batch(body):
+    # splits a batch request body into its images, raises ValueError if the lengths do not add up
+    body = memoryview(body)
+    inputs = []
+    offset = 0
+    while offset < len(body):
+        if offset + 4 > len(body):
+            raise ValueError("truncated length at byte %d" % offset)
+        size, = struct.unpack(">I", body[offset:offset + 4].tobytes())
+        offset += 4
+        if offset + size > len(body):
+            raise ValueError("image at byte %d is longer than the rest of the body" % offset)
+        inputs.append(body[offset:offset + size])
+        offset += size
+    return inputs
+
+
+class Superseded(Exception):
+    pass
 
 
 class Handler(BaseHTTPRequestHandler):
@@ -137,6 +362,10 @@ class Handler(BaseHTTPRequestHandler):
 
 
     def do_POST(self):
+        if self.path.endswith("/batch"):
+            self.do_batch(self.path[1:-len("/batch")])
+            return
+
         start = time.time()
 
         status = 200
@@ -144,6 +373,7 @@ class Handler(BaseHTTPRequestHandler):
         if "origin" in self.headers:
             headers = {"access-control-allow-origin": self.headers["origin"]}
         body = ""
+        session_id = None
 
         try:
             name = self.path[1:]
@@ -159,13 +389,25 @@ class Handler(BaseHTTPRequestHandler):
             input_data = self.rfile.read(content_len)
             input_b64data = base64.urlsafe_b64encode(input_data)
 
+            # interactive clients send a session id (and optionally a sequence number) so that
+            # only the newest drawing from each session gets run, older queued ones are dropped
+            if "x-session-id" in self.headers:
+                seq = self.headers.get("x-sequence-id")
+                if seq is not None:
+                    seq = int(seq)
+                if not session_queue.acquire(self.headers["x-session-id"], seq):
+                    raise Superseded()
+                session_id = self.headers["x-session-id"]
+
             time.sleep(a.wait)
 
             cloud_reject_prob = max(0, (cloud_requests.value() - 1.1 * cloud_accepts.value()) / (cloud_requests.value() + 1))
             # print("requests=%d accepts=%d cloud_reject_prob=%f" % (cloud_requests.value(), cloud_accepts.value(), cloud_reject_prob))
 
+            incremental = a.incremental and session_id is not None and "local" in variants and "tiles" in variants["local"]
+
             output_b64data = None
-            if "cloud" in variants and random.random() > cloud_reject_prob:
+            if "cloud" in variants and not incremental and random.random() > cloud_reject_prob:
                 input_instance = dict(input=input_b64data, key="0")
                 # the client does not seem to be threadsafe, so make one for each request
                 # also the cache is broken by oauth2client 4.0.0, so use a memory cache
@@ -183,7 +425,10 @@ class Handler(BaseHTTPRequestHandler):
             if output_b64data is None and "local" in variants and jobs.acquire(blocking=False):
                 m = variants["local"]
                 try:
-                    output_b64data = m["sess"].run(m["output"], feed_dict={m["input"]: [input_b64data]})[0]
+                    if incremental:
+                        output_b64data = base64.urlsafe_b64encode(run_incremental(m, session_id, input_data))
+                    else:
+                        output_b64data = m["sess"].run(m["output"], feed_dict={m["input"]: [input_b64data]})[0]
                 finally:
                     jobs.release()
 
@@ -199,11 +444,18 @@ class Handler(BaseHTTPRequestHandler):
                 headers["content-type"] = "image/jpeg"
             body = output_data
             successes.incr()
+        except Superseded:
+            superseded.incr()
+            status = 204
+            body = b""
         except Exception as e:
             failures.incr()
             print("exception", traceback.format_exc())
             status = 500
             body = "server error"
+        finally:
+            if session_id is not None:
+                session_queue.release(session_id)
 
         self.send_response(status)
         for key, value in headers.items():
@@ -211,7 +463,71 @@ class Handler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(body)
 
-        print("finished in %0.1fs successes=%d failures=%d" % (time.time() - start, successes.value(), failures.value()))
+        print("finished in %0.1fs successes=%d failures=%d superseded=%d" % (time.time() - start, successes.value(), failures.value(), superseded.value()))
+
+
+    def do_batch(self, name):
+        # the request and response bodies are sequences of images, each prefixed with its length as
+        # a 4 byte big endian integer, the outputs for each batch are sent as soon as it finishes
+        # and an empty output means that the corresponding input could not be processed
+        start = time.time()
+
+        try:
+            if name not in models or "batch" not in models[name].get("local", {}):
+                raise Exception("invalid model")
+
+            content_len = int(self.headers.get("content-length", "0"))
+            if content_len > a.max_batch_body:
+                raise Exception("post body too large")
+
+            if not jobs.acquire(blocking=False):
+                raise Exception("too many requests")
+        except Exception as e:
+            failures.incr()
+            print("exception", traceback.format_exc())
+            self.send_response(500)
+            self.end_headers()
+            self.wfile.write(b"server error")
+            return
+
+        # read and check the whole body before sending the status, so that a malformed body gets a 400
+        try:
+            body = self.rfile.read(content_len)
+            if len(body) != content_len:
+                raise ValueError("body ended after %d of %d bytes" % (len(body), content_len))
+            inputs = parse_batch(body)
+        except ValueError as e:
+            jobs.release()
+            failures.incr()
+            print("invalid batch body:", e)
+            self.send_response(400)
+            self.end_headers()
+            self.wfile.write(("invalid batch body: %s" % e).encode("utf8"))
+            return
+
+        count = 0
+        try:
+            self.send_response(200)
+            if "origin" in self.headers:
+                self.send_header("access-control-allow-origin", self.headers["origin"])
+            self.send_header("content-type", "application/octet-stream")
+            self.end_headers()
+
+            for batch_start in range(0, len(inputs), a.batch_size):
+                batch = [input_data.tobytes() for input_data in inputs[batch_start:batch_start + a.batch_size]]
+                for output_data in run_batch(models[name]["local"]["batch"], batch):
+                    self.wfile.write(struct.pack(">I", len(output_data)) + output_data)
+                self.wfile.flush()
+                count += len(batch)
+            successes.incr(count)
+        except Exception as e:
+            # the status has already been sent, so all we can do is close the connection early
+            failures.incr()
+            print("exception", traceback.format_exc())
+        finally:
+            jobs.release()
+
+        print("finished batch of %d in %0.1fs successes=%d failures=%d" % (count, time.time() - start, successes.value(), failures.value()))
 
 
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
@@ -231,7 +547,7 @@ def main():
             print("loading model", name)
 
             with tf.Graph().as_default() as graph:
-                sess = tf.Session(graph=graph)
+                sess = tf.Session(graph=graph, config=tf.ConfigProto(intra_op_parallelism_threads=a.intra_op_threads, inter_op_parallelism_threads=a.inter_op_threads))
                 saver = tf.train.import_meta_graph(os.path.join(a.local_models_dir, name, "export.meta"))
 
                 saver.restore(sess, os.path.join(a.local_models_dir, name, "export"))
@@ -249,6 +565,31 @@ def main():
                     output=output,
                 )
 
+                if len(tf.get_collection("windows")) > 0:
+                    windows_vars = json.loads(tf.get_collection("windows")[0])
+                    windows_input = graph.get_tensor_by_name(windows_vars["input"])
+                    windows_output = graph.get_tensor_by_name(windows_vars["output"])
+                    with tf.name_scope("batch"):
+                        png_input = tf.placeholder(tf.string, shape=[])
+                        pixels = tf.image.decode_png(png_input, channels=1)[:, :, 0]
+                        # encode the outputs in the same run as the model
+                        output_pngs = tf.map_fn(lambda image: tf.image.encode_png(tf.expand_dims(image, -1)), windows_output, dtype=tf.string)
+                    models[name]["local"]["batch"] = dict(
+                        sess=sess,
+                        shape=tuple(windows_input.get_shape().as_list()[1:]),
+                        png_input=png_input,
+                        pixels=pixels,
+                        input=windows_input,
+                        output=output_pngs,
+                    )
+
+                if len(tf.get_collection("tiles")) > 0:
+                    tile_vars = json.loads(tf.get_collection("tiles")[0])
+                    tiles = dict(tiling=Tiling(tile_vars["layers"]))
+                    for key in ["png_input", "pixels", "input", "output", "pixels_input", "png_output"]:
+                        tiles[key] = graph.get_tensor_by_name(tile_vars[key])
+                    models[name]["local"]["tiles"] = tiles
+
     if a.cloud_model_names is not None:
         import oauth2client.service_account
         import googleapiclient.discovery
@@ -0,0 +1,115 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+import numpy as np
+import argparse
+import json
+import os
+import threading
+import time
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--model_dir", required=True, help="directory containing exported model")
+parser.add_argument("--input_dir", required=True, help="directory containing input PNG image files")
+parser.add_argument("--output_dir", required=True, help="directory to write output PNG image files to")
+parser.add_argument("--batch_size", type=int, default=100, help="number of images to run through the model at once")
+parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="number of threads to use for reading, decoding, encoding and writing images")
+a = parser.parse_args()
+
+JOURNAL_NAME = "journal.txt"
+
+
+def main():
+    if not os.path.exists(a.output_dir):
+        os.makedirs(a.output_dir)
+
+    # the journal lists the names of images that have been written completely, one per line
+    # so that an interrupted run can continue where it stopped
+    journal_path = os.path.join(a.output_dir, JOURNAL_NAME)
+    completed = set()
+    if os.path.exists(journal_path):
+        with open(journal_path) as f:
+            completed = set(line.rstrip("\n") for line in f)
+
+    names = sorted(name for name in os.listdir(a.input_dir) if name.lower().endswith(".png") and name not in completed)
+    print("skipping %d images that were already completed" % len(completed))
+    print("processing %d images" % len(names))
+    if len(names) == 0:
+        return
+
+    saver = tf.train.import_meta_graph(os.path.join(a.model_dir, "export.meta"))
+    if len(tf.get_collection("windows")) == 0:
+        raise Exception("exported model does not support batches, export it again with pix2pix.py --mode export")
+    windows_vars = json.loads(tf.get_collection("windows")[0])
+    windows_input = tf.get_default_graph().get_tensor_by_name(windows_vars["input"])
+    windows_output = tf.get_default_graph().get_tensor_by_name(windows_vars["output"])
+    _, height, width = windows_input.get_shape().as_list()
+
+    # decoding and encoding release the GIL while they run so threads can do them in parallel
+    png_input = tf.placeholder(tf.string, shape=[])
+    decoded = tf.image.decode_png(png_input, channels=1)[:, :, 0]
+    pixels = tf.placeholder(tf.uint8, shape=[height, width])
+    png_output = tf.image.encode_png(tf.expand_dims(pixels, -1))
+
+    journal_lock = threading.Lock()
+
+    with tf.Session() as sess, open(journal_path, "a") as journal:
+        saver.restore(sess, os.path.join(a.model_dir, "export"))
+
+        def load(name):
+            with open(os.path.join(a.input_dir, name), "rb") as f:
+                image = sess.run(decoded, feed_dict={png_input: f.read()})
+            if image.shape != (height, width):
+                raise Exception("%s has size %dx%d instead of %dx%d" % (name, image.shape[0], image.shape[1], height, width))
+            return image
+
+        def save(args):
+            name, image = args
+            encoded = sess.run(png_output, feed_dict={pixels: image})
+            path = os.path.join(a.output_dir, name)
+            # write to a temporary file first so that a crash cannot leave a truncated image behind
+            with open(path + ".tmp", "wb") as f:
+                f.write(encoded)
+            os.rename(path + ".tmp", path)
+            with journal_lock:
+                journal.write(name + "\n")
+                journal.flush()
+
+        decode_pool = ThreadPool(a.workers)
+        write_pool = ThreadPool(a.workers)
+
+        batches = [names[i:i + a.batch_size] for i in range(0, len(names), a.batch_size)]
+        start = time.time()
+        num_complete = 0
+        # decode the next batch and write the previous batch while the model runs on the current one
+        pending_load = decode_pool.map_async(load, batches[0])
+        pending_save = None
+        for i, batch in enumerate(batches):
+            images = np.stack(pending_load.get())
+            if i + 1 < len(batches):
+                pending_load = decode_pool.map_async(load, batches[i + 1])
+
+            outputs = sess.run(windows_output, feed_dict={windows_input: images})
+
+            if pending_save is not None:
+                pending_save.get()
+                num_complete += len(batches[i - 1])
+            pending_save = write_pool.map_async(save, zip(batch, outputs))
+
+            elapsed = time.time() - start
+            print("%d/%d complete  %0.2f images/sec  %dm%ds elapsed" % (num_complete, len(names), num_complete / elapsed, elapsed // 60, elapsed % 60))
+
+        pending_save.get()
+        num_complete += len(batches[-1])
+        elapsed = time.time() - start
+        print("%d/%d complete  %0.2f images/sec  %dm%ds elapsed" % (num_complete, len(names), num_complete / elapsed, elapsed // 60, elapsed % 60))
+
+        decode_pool.close()
+        write_pool.close()
+
+main()
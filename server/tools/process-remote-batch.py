@@ -0,0 +1,66 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+try:
+    from urllib.request import urlopen # python 3
+except ImportError:
+    from urllib2 import urlopen # python 2
+import argparse
+import os
+import struct
+import time
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--input_dir", required=True, help="directory containing input PNG image files")
+parser.add_argument("--url", required=True, help="batch url to use for processing, e.g. http://localhost:8000/example/batch")
+parser.add_argument("--output_dir", required=True, help="directory to write output PNG image files to")
+parser.add_argument("--request_size", type=int, default=1000, help="number of images to send in each request")
+a = parser.parse_args()
+
+
+def read_exactly(f, size):
+    data = b""
+    while len(data) < size:
+        chunk = f.read(size - len(data))
+        if len(chunk) == 0:
+            raise Exception("response ended early")
+        data += chunk
+    return data
+
+
+def main():
+    if not os.path.exists(a.output_dir):
+        os.makedirs(a.output_dir)
+
+    names = sorted(name for name in os.listdir(a.input_dir) if name.lower().endswith(".png"))
+
+    start = time.time()
+    failed = 0
+    for i in range(0, len(names), a.request_size):
+        request_names = names[i:i + a.request_size]
+        body = []
+        for name in request_names:
+            with open(os.path.join(a.input_dir, name), "rb") as f:
+                data = f.read()
+            body.append(struct.pack(">I", len(data)))
+            body.append(data)
+
+        response = urlopen(a.url, data=b"".join(body))
+        for name in request_names:
+            size, = struct.unpack(">I", read_exactly(response, 4))
+            if size == 0:
+                print("failed to process", name)
+                failed += 1
+                continue
+            with open(os.path.join(a.output_dir, name), "wb") as f:
+                f.write(read_exactly(response, size))
+
+        elapsed = time.time() - start
+        done = i + len(request_names)
+        print("%d/%d complete  %0.2f images/sec" % (done, len(names), done / elapsed))
+
+    print("%d failed" % failed)
+
+main()
@@ -0,0 +1,130 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# tries short runs of pix2pix.py with different thread pool sizes, batch sizes and queue capacities
+# and writes the fastest settings to the profile that pix2pix.py and server/serve.py load
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+parser = argparse.ArgumentParser(epilog="any other arguments, e.g. --convolution True, are passed to pix2pix.py")
+parser.add_argument("--input_dir", required=True, help="training data to tune on")
+parser.add_argument("--output", default=os.environ.get("PIX2PIX_PROFILE", os.path.expanduser(os.path.join("~", ".pix2pix", "profile.json"))), help="profile to write")
+parser.add_argument("--steps", type=int, default=20, help="number of training steps to time for each candidate")
+parser.add_argument("--warmup", type=int, default=5, help="number of training steps to run before timing")
+parser.add_argument("--batch_sizes", default="16,32,64,100", help="comma separated list of training batch sizes to try")
+parser.add_argument("--queue_capacities", default="32,128,512", help="comma separated list of input queue capacities to try")
+parser.add_argument("--serve_batch_sizes", default="1,8,32", help="comma separated list of batch sizes to try for server/serve.py batch requests")
+a, pix2pix_args = parser.parse_known_args()
+
+pix2pix_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pix2pix.py")
+
+
+def split(value):
+    return [int(item) for item in value.split(",")]
+
+
+def thread_candidates():
+    # (intra_op_threads, inter_op_threads), 0 is the tensorflow default of one thread per core for each pool
+    cores = multiprocessing.cpu_count()
+    intra = sorted(set([0, 1, max(cores // 2, 1), cores]))
+    inter = sorted(set([0, 1, 2]))
+    return [(i, j) for i in intra for j in inter]
+
+
+def run(mode, settings, output_dir):
+    args = [sys.executable, pix2pix_path, "--mode", mode, "--output_dir", output_dir, "--seed", "0"]
+    for key, val in sorted(settings.items()):
+        if val is True:
+            args.append("--" + key)
+        else:
+            args += ["--" + key, str(val)]
+    args += pix2pix_args
+    with open(os.devnull, "w") as devnull:
+        # candidates that run out of memory just fail
+        return subprocess.call(args, stdout=devnull, stderr=devnull) == 0
+
+
+def train_rate(settings, output_dir):
+    settings = dict(settings)
+    settings.update({
+        "input_dir": a.input_dir,
+        "max_steps": a.warmup + a.steps,
+        "summary_freq": 0,
+        "progress_freq": 0,
+        "save_freq": 0,
+        "telemetry": True,
+    })
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    if not run("train", settings, output_dir):
+        return None
+
+    # the step timings from --telemetry leave out startup and graph construction
+    with open(os.path.join(output_dir, "telemetry.jsonl")) as f:
+        steps = [json.loads(line) for line in f][a.warmup:]
+    elapsed = sum(step.get("queue_wait", 0) + step["run"] for step in steps)
+    return settings["batch_size"] * len(steps) / elapsed
+
+
+def forward_rate(settings, output_dir):
+    settings = dict(settings)
+    settings["benchmark_steps"] = a.steps
+    if not run("benchmark", settings, output_dir):
+        return None
+    with open(os.path.join(output_dir, "benchmark.json")) as f:
+        return json.loads(f.read())["generator_forward"]
+
+
+def search(name, rate_func, best, key, candidates, output_dir):
+    # tune one setting at a time, starting from the best settings so far
+    best_rate = None
+    best_value = None
+    for value in candidates:
+        settings = dict(best)
+        settings.update(zip(key, value) if isinstance(key, tuple) else [(key, value)])
+        rate = rate_func(settings, output_dir)
+        print("%-6s %-60s %s" % (name, json.dumps(settings, sort_keys=True), "failed" if rate is None else "%0.1f images/sec" % rate))
+        sys.stdout.flush()
+        if rate is not None and (best_rate is None or rate > best_rate):
+            best_rate = rate
+            best_value = value
+    if best_value is None:
+        raise Exception("all candidates failed for %s" % (key,))
+    best.update(zip(key, best_value) if isinstance(key, tuple) else [(key, best_value)])
+    return best_rate
+
+
+def main():
+    output_dir = tempfile.mkdtemp()
+    try:
+        train = {"intra_op_threads": 0, "inter_op_threads": 0, "batch_size": split(a.batch_sizes)[0], "queue_capacity": 32}
+        search("train", train_rate, train, ("intra_op_threads", "inter_op_threads"), thread_candidates(), output_dir)
+        search("train", train_rate, train, "batch_size", split(a.batch_sizes), output_dir)
+        rate = search("train", train_rate, train, "queue_capacity", split(a.queue_capacities), output_dir)
+        print("best training settings", json.dumps(train, sort_keys=True), "%0.1f images/sec" % rate)
+
+        # single requests are latency sensitive, so pick the threads for batches of 1 and then the batch size for batch requests
+        serve = {"intra_op_threads": 0, "inter_op_threads": 0, "batch_size": 1}
+        search("serve", forward_rate, serve, ("intra_op_threads", "inter_op_threads"), thread_candidates(), output_dir)
+        rate = search("serve", forward_rate, serve, "batch_size", split(a.serve_batch_sizes), output_dir)
+        print("best serving settings", json.dumps(serve, sort_keys=True), "%0.1f images/sec" % rate)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    profile = {"train": train, "serve": serve}
+    if os.path.dirname(a.output) != "" and not os.path.exists(os.path.dirname(a.output)):
+        os.makedirs(os.path.dirname(a.output))
+    with open(a.output, "w") as f:
+        f.write(json.dumps(profile, sort_keys=True, indent=4))
+    print("wrote profile to", a.output)
+
+main()
@@ -0,0 +1,140 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# runs pix2pix.py --mode benchmark for a matrix of model configurations on the CPU and compares runs
+
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import shutil
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--output", help="json file to write the results to")
+parser.add_argument("--models", default="convolution,lstm", help="comma separated list of generators to benchmark, convolution and/or lstm")
+parser.add_argument("--ngf", default="96", help="comma separated list of numbers of generator filters")
+parser.add_argument("--ndf", default="96", help="comma separated list of numbers of discriminator filters")
+parser.add_argument("--batch_size", default="1,16", help="comma separated list of batch sizes")
+parser.add_argument("--threads", default="0", help="comma separated list of intra op thread counts, 0 for the tensorflow default")
+parser.add_argument("--recompute", default="", help="semicolon separated list of pix2pix.py --recompute settings to compare, e.g. ';generator/*;generator/generator_rnn_*', an empty setting recomputes nothing")
+parser.add_argument("--micro_batches", default="1", help="comma separated list of pix2pix.py --micro_batches settings to compare")
+parser.add_argument("--steps", type=int, default=20, help="number of steps to time for each part of the model")
+parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="compare two result files instead of running the benchmarks")
+parser.add_argument("--tolerance", type=float, default=0.1, help="fraction that throughput may drop or memory may grow by before --compare reports a regression")
+a = parser.parse_args()
+
+pix2pix_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pix2pix.py")
+
+# lower is better for memory, higher is better for everything else
+METRICS = ["generator_forward", "discriminator_forward", "forward_backward", "train", "peak_memory_mb"]
+
+
+def key(config):
+    return json.dumps(config, sort_keys=True)
+
+
+def split(value, convert=int):
+    return [convert(item) for item in value.split(",")]
+
+
+def run(config, output_dir):
+    args = [
+        sys.executable, pix2pix_path,
+        "--mode", "benchmark",
+        "--output_dir", output_dir,
+        "--batch_size", str(config["batch_size"]),
+        "--ngf", str(config["ngf"]),
+        "--ndf", str(config["ndf"]),
+        "--intra_op_threads", str(config["threads"]),
+        "--benchmark_steps", str(a.steps),
+        # the flag is parsed with type=bool, so only pass it to enable the model
+        "--" + config["model"], "True",
+    ]
+    if config.get("recompute", "") != "":
+        args += ["--recompute", config["recompute"]]
+    if config.get("micro_batches", 1) != 1:
+        args += ["--micro_batches", str(config["micro_batches"])]
+    env = dict(os.environ)
+    env["CUDA_VISIBLE_DEVICES"] = ""
+    # a process for each configuration so that the peak memory is only for that configuration
+    subprocess.check_call(args, env=env)
+    with open(os.path.join(output_dir, "benchmark.json")) as f:
+        return json.loads(f.read())
+
+
+def benchmark():
+    configs = []
+    for model, ngf, ndf, batch_size, threads, recompute, micro_batches in itertools.product(split(a.models, str), split(a.ngf), split(a.ndf), split(a.batch_size), split(a.threads), a.recompute.split(";"), split(a.micro_batches)):
+        if batch_size % micro_batches != 0:
+            continue
+        config = {"model": model, "ngf": ngf, "ndf": ndf, "batch_size": batch_size, "threads": threads}
+        # left out when not used so that results from before --recompute and --micro_batches still compare
+        if recompute != "":
+            config["recompute"] = recompute
+        if micro_batches != 1:
+            config["micro_batches"] = micro_batches
+        configs.append(config)
+
+    results = []
+    output_dir = tempfile.mkdtemp()
+    try:
+        for config in configs:
+            print("benchmarking", key(config))
+            sys.stdout.flush()
+            results.append({"config": config, "results": run(config, output_dir)})
+    finally:
+        shutil.rmtree(output_dir)
+
+    print()
+    print("%-60s %s" % ("config", "  ".join("%14s" % metric for metric in METRICS)))
+    for result in results:
+        values = ["%14.1f" % result["results"][metric] if metric in result["results"] else "%14s" % "-" for metric in METRICS]
+        print("%-60s %s" % (key(result["config"]), "  ".join(values)))
+
+    if a.output is not None:
+        with open(a.output, "w") as f:
+            f.write(json.dumps(results, sort_keys=True, indent=4))
+
+
+def compare():
+    with open(a.compare[0]) as f:
+        baseline = dict((key(result["config"]), result["results"]) for result in json.loads(f.read()))
+    with open(a.compare[1]) as f:
+        current = dict((key(result["config"]), result["results"]) for result in json.loads(f.read()))
+
+    regressions = 0
+    for config in sorted(set(baseline) & set(current)):
+        for metric in METRICS:
+            if metric not in baseline[config] or metric not in current[config]:
+                continue
+            before = baseline[config][metric]
+            after = current[config][metric]
+            change = (after - before) / before
+            if metric == "peak_memory_mb":
+                regressed = change > a.tolerance
+            else:
+                regressed = change < -a.tolerance
+            print("%-60s %-22s %10.1f -> %10.1f  %+6.1f%%%s" % (config, metric, before, after, change * 100, "  REGRESSION" if regressed else ""))
+            if regressed:
+                regressions += 1
+
+    for config in sorted(set(baseline) ^ set(current)):
+        print("%-60s only in %s" % (config, a.compare[0] if config in baseline else a.compare[1]))
+
+    if regressions > 0:
+        print("%d regressions" % regressions)
+        sys.exit(1)
+
+
+def main():
+    if a.compare is not None:
+        compare()
+    else:
+        benchmark()
+
+main()
@@ -0,0 +1,133 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# checks that settings which should not change what the model learns really do not, by training from the same
+# checkpoint with and without the setting on the CPU and comparing the checkpoints afterwards
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import numpy as np
+import tensorflow as tf
+
+tools_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(tools_dir)
+sys.path.insert(0, tools_dir)
+import npimage
+
+
+# the settings to compare against a plain run, for --micro_batches the model has to be one without batchnorm,
+# which normalizes each part with the statistics of only that part
+CHECKS = {
+    "micro_batches": lambda: ["--micro_batches", str(a.micro_batches)],
+    "steps_per_run": lambda: ["--steps_per_run", str(a.steps)],
+}
+
+# --micro_batches adds up the gradients in a different order, which is only the same up to rounding, and the first
+# adam steps move each weight by about the learning rate in the direction of its gradient, however small, so the
+# weights can end up far apart, instead it compares the gradients of a single step, which the first adam moments are
+# after one step, times 1 - beta1
+GRADIENTS_ONLY = ["micro_batches"]
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--check", required=True, choices=sorted(CHECKS.keys()), help="setting to compare against a plain run, --steps_per_run runs all of the steps in one session.run")
+parser.add_argument("--work_dir", help="directory to write the dataset and outputs to, a temporary directory if not specified")
+parser.add_argument("--model", default="lstm", choices=["convolution", "lstm"], help="generator to use, the lstm model has no batchnorm")
+parser.add_argument("--ngf", type=int, default=8, help="number of generator filters for the convolution model")
+parser.add_argument("--ndf", type=int, default=8, help="number of discriminator filters for the convolution model")
+parser.add_argument("--batch_size", type=int, default=4, help="batch size for training")
+parser.add_argument("--micro_batches", type=int, default=2, help="number of parts to split each batch into for the micro_batches check")
+parser.add_argument("--steps", type=int, default=3, help="number of training steps to compare, the checks of the gradients take a single step")
+parser.add_argument("--tolerance", type=float, default=1e-4, help="largest difference allowed between the variables of the two runs, as a fraction of the largest value of each variable")
+parser.add_argument("options", nargs="*", help="more pix2pix.py options for all of the runs, after --, e.g. -- --gan_weight 0")
+a = parser.parse_args()
+
+env = dict(os.environ)
+env["CUDA_VISIBLE_DEVICES"] = ""
+
+
+def generate(d, count, seed):
+    rng = np.random.RandomState(seed)
+    os.makedirs(d)
+    for i in range(count):
+        pair = rng.randint(0, 256, size=[64, 512, 1]).astype(np.uint8)
+        npimage.write(npimage.encode(pair, ".png"), os.path.join(d, "%d.png" % i))
+
+
+def train(output_dir, max_steps, *args):
+    # no dropout, so that both runs compute the same thing, and only a checkpoint at the end
+    args = [
+        sys.executable, os.path.join(root_dir, "pix2pix.py"),
+        "--mode", "train",
+        "--output_dir", output_dir,
+        "--seed", "0",
+        "--dropout", "0",
+        "--batch_size", str(a.batch_size),
+        "--max_steps", str(max_steps),
+        "--save_freq", str(max_steps),
+        "--summary_freq", "0",
+        "--progress_freq", "0",
+        "--" + a.model, "True",
+        "--ngf", str(a.ngf),
+        "--ndf", str(a.ndf),
+    ] + list(args) + a.options
+    print(" ".join(args))
+    sys.stdout.flush()
+    subprocess.check_call(args, env=env)
+
+
+def compare(baseline_dir, current_dir):
+    baseline = tf.train.load_checkpoint(tf.train.latest_checkpoint(baseline_dir))
+    current = tf.train.load_checkpoint(tf.train.latest_checkpoint(current_dir))
+    names = sorted(baseline.get_variable_to_shape_map().keys())
+    if names != sorted(current.get_variable_to_shape_map().keys()):
+        raise Exception("the checkpoints do not have the same variables")
+    if a.check in GRADIENTS_ONLY:
+        names = [name for name in names if name.endswith("/Adam")]
+
+    largest = 0.0
+    for name in names:
+        expected = baseline.get_tensor(name).astype(np.float64)
+        scale = max(float(np.max(np.abs(expected))), 1e-12)
+        difference = float(np.max(np.abs(expected - current.get_tensor(name)))) / scale
+        if difference > a.tolerance:
+            print("%-70s %g" % (name, difference))
+        largest = max(largest, difference)
+    print("largest difference %g over %d variables" % (largest, len(names)))
+    return largest <= a.tolerance
+
+
+def main():
+    work_dir = a.work_dir
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp()
+    elif os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+
+    steps = 1 if a.check in GRADIENTS_ONLY else a.steps
+    try:
+        input_dir = os.path.join(work_dir, "pairs")
+        generate(input_dir, a.batch_size * steps, seed=0)
+
+        # both runs start from the same weights, the initial values depend on the rest of the graph
+        start_dir = os.path.join(work_dir, "start")
+        train(start_dir, 1, "--input_dir", input_dir)
+
+        baseline_dir = os.path.join(work_dir, "baseline")
+        train(baseline_dir, steps, "--input_dir", input_dir, "--checkpoint", start_dir)
+        current_dir = os.path.join(work_dir, a.check)
+        train(current_dir, steps, "--input_dir", input_dir, "--checkpoint", start_dir, *CHECKS[a.check]())
+
+        if not compare(baseline_dir, current_dir):
+            print("%s changes what is learned" % a.check)
+            sys.exit(1)
+        print("%s gives the same variables as a plain run" % a.check)
+    finally:
+        if a.work_dir is None:
+            shutil.rmtree(work_dir)
+
+main()
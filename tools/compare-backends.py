@@ -0,0 +1,86 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# checks that npimage.py produces the same images as tfimage.py and compares startup time and throughput
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--input_dir", help="images to use, random images are generated if not specified")
+parser.add_argument("--count", type=int, default=20, help="number of images to use")
+parser.add_argument("--tolerance", type=int, default=2, help="largest allowed difference between the backends in uint8 levels")
+a = parser.parse_args()
+
+tools_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def startup(module):
+    # time a fresh process that only imports the backend, like process.py does
+    code = "import resource, %s; print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)" % module
+    start = time.time()
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=tools_dir)
+    return time.time() - start, int(output.strip().splitlines()[-1])
+
+
+def main():
+    for module in ["tfimage", "npimage"]:
+        elapsed, maxrss = startup(module)
+        print("startup  %-8s  %0.2fs  %dMB max rss" % (module, elapsed, maxrss // 1024))
+
+    sys.path.insert(0, tools_dir)
+    import tensorflow as tf
+    import tfimage
+    import npimage
+
+    if a.input_dir is None:
+        rng = np.random.RandomState(0)
+        images = []
+        for _ in range(a.count):
+            height, width = rng.randint(128, 512, size=2)
+            # smooth random images so that resizing does something more realistic than on noise
+            image = rng.rand(height // 8 + 1, width // 8 + 1, 3)
+            image = np.kron(image, np.ones([8, 8, 1]))[:height, :width]
+            images.append(npimage.encode(image.astype(np.float32), ".png"))
+    else:
+        images = [npimage.read(path) for path in npimage.find(a.input_dir)[:a.count]]
+
+    ops = [
+        ("grayscale", lambda im, image: im.grayscale_to_rgb(images=im.rgb_to_grayscale(images=image))),
+        ("downscale", lambda im, image: im.downscale(images=image, size=[100, 100])),
+        ("upscale", lambda im, image: im.upscale(images=image, size=[600, 600])),
+        ("crop", lambda im, image: im.crop(image=image, offset_height=10, offset_width=20, target_height=100, target_width=90)),
+        ("pad", lambda im, image: im.pad(image=image, offset_height=10, offset_width=20, target_height=600, target_width=600)),
+    ]
+
+    failed = False
+    with tf.Session():
+        decoded = {
+            "tfimage": [tfimage.to_float32(image=tfimage.decode_png(contents=contents)) for contents in images],
+            "npimage": [npimage.decode(contents) for contents in images],
+        }
+
+        for name, op in ops:
+            outputs = {}
+            for module, im in [("tfimage", tfimage), ("npimage", npimage)]:
+                start = time.time()
+                outputs[module] = [npimage.to_uint8(op(im, image)) for image in decoded[module]]
+                rate = len(images) / (time.time() - start)
+                print("%-10s  %-8s  %0.1f images/sec" % (name, module, rate))
+
+            difference = max(np.max(np.abs(x.astype(np.int32) - y)) for x, y in zip(outputs["tfimage"], outputs["npimage"]))
+            print("%-10s  max difference %d" % (name, difference))
+            if difference > a.tolerance:
+                failed = True
+
+    if failed:
+        print("backends differ by more than %d" % a.tolerance)
+        sys.exit(1)
+
+main()
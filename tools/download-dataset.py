@@ -3,22 +3,205 @@ from __future__ import division
 from __future__ import print_function
 
 try:
-    from urllib.request import urlopen # python 3
+    from urllib.request import urlopen, Request # python 3
+    from http.client import HTTPException
 except ImportError:
-    from urllib2 import urlopen # python 2
-import sys
-import tarfile
-import tempfile
+    from urllib2 import urlopen, Request # python 2
+    from httplib import HTTPException
+import argparse
+import hashlib
+import json
+import os
 import shutil
+import socket
+import tarfile
+import time
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("dataset", help="name of the dataset to download, e.g. facades")
+parser.add_argument("--url", default="https://people.eecs.berkeley.edu/~tinghuiz/projects/pix2pix/datasets/%s.tar.gz", help="url to download the dataset from, %%s is replaced with the dataset name")
+parser.add_argument("--sha256", help="expected sha256 of the archive, the dataset is not moved into place if it does not match")
+parser.add_argument("--no_resume", action="store_true", help="do not keep the partial download on disk, which halves peak disk use but an interrupted download starts over")
+parser.add_argument("--retries", type=int, default=5, help="number of times to reconnect when the connection drops")
+parser.add_argument("--pack", action="store_true", help="write each directory in the archive to a single tfrecords file instead of extracting the images")
+a = parser.parse_args()
+
+CHUNK_SIZE = 1024 * 1024
+REPORT_SIZE = 16 * 1024 * 1024
+
+
+class Download(object):
+    # file-like object for tarfile that replays the partial download on disk and then continues
+    # from the url, reconnecting with a range request whenever the connection drops
+    def __init__(self, url, part_path):
+        self.url = url
+        self.offset = 0
+        self.total = None
+        self.sha256 = hashlib.sha256()
+        self.response = None
+        self.replay = None
+        self.part = None
+        if part_path is not None:
+            if os.path.exists(part_path):
+                self.replay = open(part_path, "rb")
+            self.part = open(part_path, "ab")
+
+    def _open(self):
+        request = Request(self.url)
+        if self.offset > 0:
+            request.add_header("Range", "bytes=%d-" % self.offset)
+        response = urlopen(request, timeout=60)
+        length = response.info().get("Content-Length")
+
+        if self.offset > 0 and response.getcode() != 206:
+            # the server does not support ranges, skip what we already have
+            remaining = self.offset
+            while remaining > 0:
+                data = response.read(min(remaining, CHUNK_SIZE))
+                if len(data) == 0:
+                    raise IOError("response ended early")
+                remaining -= len(data)
+            if length is not None:
+                self.total = int(length)
+        elif length is not None:
+            self.total = self.offset + int(length)
+        return response
+
+    def _download(self, size):
+        for attempt in range(a.retries + 1):
+            try:
+                if self.response is None:
+                    self.response = self._open()
+                data = self.response.read(size)
+                if len(data) > 0 or self.total is None or self.offset >= self.total:
+                    return data
+                raise IOError("connection closed at %d of %d bytes" % (self.offset, self.total))
+            except (IOError, socket.error, HTTPException) as e:
+                if attempt == a.retries:
+                    raise
+                print("download interrupted (%s), resuming at %d bytes" % (e, self.offset))
+                self.response = None
+                time.sleep(2 ** attempt)
+
+    def read(self, size=CHUNK_SIZE):
+        if size is None or size < 0:
+            size = CHUNK_SIZE
+
+        if self.replay is not None:
+            data = self.replay.read(size)
+            if len(data) > 0:
+                self._consume(data)
+                return data
+            self.replay.close()
+            self.replay = None
+            if self.offset > 0:
+                print("resuming download at %d bytes" % self.offset)
+
+        data = self._download(size)
+        if self.part is not None:
+            self.part.write(data)
+        self._consume(data)
+        return data
+
+    def _consume(self, data):
+        if (self.offset + len(data)) // REPORT_SIZE > self.offset // REPORT_SIZE:
+            if self.total is None:
+                print("%dMB" % ((self.offset + len(data)) // 1024 // 1024))
+            else:
+                print("%dMB/%dMB" % ((self.offset + len(data)) // 1024 // 1024, self.total // 1024 // 1024))
+        self.offset += len(data)
+        self.sha256.update(data)
+
+    def close(self):
+        if self.part is not None:
+            self.part.close()
+        if self.replay is not None:
+            self.replay.close()
+
+
+def check_member(member):
+    if member.name.startswith("/") or ".." in member.name.split("/"):
+        raise Exception("unsafe path in archive: " + member.name)
+
+
+def extract(tar, dst_dir):
+    for member in tar:
+        check_member(member)
+        tar.extract(member, dst_dir)
+
+
+def pack(tar, dst_dir):
+    # same format as tools/process.py --operation prepare --pack, one tfrecords file per directory
+    import tensorflow as tf
+    writers = {}
+    counts = {}
+    for member in tar:
+        check_member(member)
+        _, ext = os.path.splitext(member.name.lower())
+        if not member.isfile() or ext not in [".jpg", ".png"]:
+            continue
+
+        dirname, name = os.path.split(member.name)
+        if dirname not in writers:
+            os.makedirs(os.path.join(dst_dir, dirname))
+            writers[dirname] = tf.python_io.TFRecordWriter(os.path.join(dst_dir, dirname, "examples.tfrecords"))
+            counts[dirname] = 0
+
+        example = tf.train.Example(features=tf.train.Features(feature={
+            "path": tf.train.Feature(bytes_list=tf.train.BytesList(value=[name.encode("utf8")])),
+            "image": tf.train.Feature(bytes_list=tf.train.BytesList(value=[tar.extractfile(member).read()])),
+        }))
+        writers[dirname].write(example.SerializeToString())
+        counts[dirname] += 1
+
+    for dirname, writer in writers.items():
+        writer.close()
+        with open(os.path.join(dst_dir, dirname, "examples.json"), "w") as f:
+            f.write(json.dumps({"count": counts[dirname]}))
+
+
+def main():
+    url = a.url % a.dataset if "%s" in a.url else a.url
+    part_path = None if a.no_resume else a.dataset + ".tar.gz.part"
+    # extract next to the final location and only move the files into place once the archive is verified
+    staging_dir = a.dataset + ".partial"
+    if os.path.exists(staging_dir):
+        shutil.rmtree(staging_dir)
+    os.makedirs(staging_dir)
 
-dataset = sys.argv[1]
-url = "https://people.eecs.berkeley.edu/~tinghuiz/projects/pix2pix/datasets/%s.tar.gz" % dataset
-with tempfile.TemporaryFile() as tmp:
     print("downloading", url)
-    shutil.copyfileobj(urlopen(url), tmp)
-    print("extracting")
-    tmp.seek(0)
-    tar = tarfile.open(fileobj=tmp)
-    tar.extractall()
-    tar.close()
+    download = Download(url, part_path)
+    try:
+        # extract while downloading instead of saving the archive and reading it a second time
+        tar = tarfile.open(fileobj=download, mode="r|gz")
+        if a.pack:
+            pack(tar, staging_dir)
+        else:
+            extract(tar, staging_dir)
+        tar.close()
+        # read to the end of the archive so that the checksum covers all of it
+        while len(download.read()) > 0:
+            pass
+    finally:
+        download.close()
+
+    digest = download.sha256.hexdigest()
+    print("sha256", digest)
+    if a.sha256 is not None and digest != a.sha256.lower():
+        shutil.rmtree(staging_dir)
+        if part_path is not None:
+            os.remove(part_path)
+        raise Exception("checksum does not match, expected %s" % a.sha256)
+
+    for name in os.listdir(staging_dir):
+        if os.path.exists(name):
+            raise Exception("%s already exists, the dataset is in %s" % (name, staging_dir))
+    for name in os.listdir(staging_dir):
+        os.rename(os.path.join(staging_dir, name), name)
+    os.rmdir(staging_dir)
+    if part_path is not None:
+        os.remove(part_path)
     print("done")
+
+main()
@@ -0,0 +1,195 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# numpy and pillow versions of the functions in tfimage.py, these do not need tensorflow or a session
+# and keep images as uint8 where tfimage would convert them to float32
+
+import numpy as np
+import os
+import io
+from PIL import Image
+
+# resampling weights for each (method, in_size, out_size), since most jobs resize many images of the same size
+weights_cache = {}
+
+
+def to_float32(image):
+    if image.dtype == np.float32:
+        return image
+    return image.astype(np.float32) * np.float32(1.0 / 255)
+
+
+def to_uint8(image):
+    if image.dtype == np.uint8:
+        return image
+    # same rounding as tf.image.convert_image_dtype with saturate=True
+    return np.clip(image * np.float32(255.5), 0, 255).astype(np.uint8)
+
+
+def _like(image, dtype):
+    # convert a float32 image back to dtype
+    if dtype == np.uint8:
+        return np.clip(np.round(image * 255), 0, 255).astype(np.uint8)
+    return image.astype(dtype)
+
+
+def crop(image, offset_height, offset_width, target_height, target_width):
+    return image[offset_height:offset_height + target_height, offset_width:offset_width + target_width]
+
+
+def pad(image, offset_height, offset_width, target_height, target_width):
+    height, width, channels = image.shape
+    result = np.zeros([target_height, target_width, channels], dtype=image.dtype)
+    result[offset_height:offset_height + height, offset_width:offset_width + width] = image
+    return result
+
+
+def _area_weights(in_size, out_size):
+    # same as tf.image.resize_images with ResizeMethod.AREA, each output pixel is the average of the
+    # input pixels it covers, weighted by how much of each one it covers
+    scale = in_size / out_size
+    weights = np.zeros([out_size, in_size], dtype=np.float32)
+    for o in range(out_size):
+        start, end = o * scale, (o + 1) * scale
+        for i in range(int(np.floor(start)), int(np.ceil(end))):
+            weights[o, min(i, in_size - 1)] += (min(i + 1, end) - max(i, start)) / scale
+    return weights
+
+
+def _bicubic_weights(in_size, out_size, A=-0.75):
+    # same as tf.image.resize_images with ResizeMethod.BICUBIC (without align_corners or half pixel centers)
+    def kernel(x):
+        x = abs(x)
+        if x <= 1:
+            return ((A + 2) * x - (A + 3)) * x * x + 1
+        if x < 2:
+            return ((A * x - 5 * A) * x + 8 * A) * x - 4 * A
+        return 0
+
+    scale = in_size / out_size
+    weights = np.zeros([out_size, in_size], dtype=np.float32)
+    for o in range(out_size):
+        position = o * scale
+        index = int(np.floor(position))
+        for i in range(index - 1, index + 3):
+            weights[o, min(max(i, 0), in_size - 1)] += kernel(position - i)
+    return weights
+
+
+def _cached_weights(create_weights, in_size, out_size):
+    key = (create_weights, in_size, out_size)
+    if key not in weights_cache:
+        weights_cache[key] = create_weights(in_size, out_size)
+    return weights_cache[key]
+
+
+def _resample(images, size, create_weights):
+    height, width, _ = images.shape
+    weights_y = _cached_weights(create_weights, height, size[0])
+    weights_x = _cached_weights(create_weights, width, size[1])
+    # resampling is separable, so do the rows and then the columns as matrix multiplies
+    result = np.tensordot(weights_y, to_float32(images), axes=([1], [0]))
+    result = np.tensordot(result, weights_x, axes=([1], [1])).transpose(0, 2, 1)
+    return _like(result, images.dtype)
+
+
+def downscale(images, size):
+    return _resample(images, size, _area_weights)
+
+
+def upscale(images, size):
+    return _resample(images, size, _bicubic_weights)
+
+
+def rgb_to_grayscale(images):
+    # same weights as tf.image.rgb_to_grayscale
+    gray = np.tensordot(to_float32(images), np.array([0.2989, 0.5870, 0.1140], dtype=np.float32), axes=([-1], [0]))
+    return _like(gray[..., np.newaxis], images.dtype)
+
+
+def grayscale_to_rgb(images):
+    return np.repeat(images, 3, axis=-1)
+
+
+def decode(contents):
+    image = Image.open(io.BytesIO(contents))
+    # match the channels that tf.image.decode_png and tf.image.decode_jpeg produce
+    if image.mode == "P":
+        image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+    elif image.mode == "CMYK":
+        image = image.convert("RGB")
+    elif image.mode not in ("L", "LA", "RGB", "RGBA"):
+        image = image.convert("L")
+
+    # copy so that operations can modify the image in place
+    image = np.array(image)
+    if image.ndim == 2:
+        image = image[:, :, np.newaxis]
+    return image
+
+
+def encode(image, ext):
+    image = to_uint8(image)
+    if image.shape[2] == 1:
+        image = image[:, :, 0]
+
+    output = io.BytesIO()
+    if ext == ".jpg":
+        # tf.image.encode_jpeg defaults to quality 95
+        Image.fromarray(image).save(output, format="JPEG", quality=95)
+    elif ext == ".png":
+        Image.fromarray(image).save(output, format="PNG")
+    else:
+        raise Exception("invalid image suffix")
+    return output.getvalue()
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def load(path):
+    _, ext = os.path.splitext(path.lower())
+    if ext != ".jpg" and ext != ".png":
+        raise Exception("invalid image suffix")
+    return decode(read(path))
+
+
+def save(image, path, replace=False):
+    _, ext = os.path.splitext(path.lower())
+    write(encode(image, ext), path, replace=replace)
+
+
+def find(d):
+    if os.path.isfile(d):
+        # split manifest written by split.py --manifest, with one image name per line
+        with open(d) as f:
+            return [os.path.join(os.path.dirname(d), line.rstrip("\n")) for line in f if line.strip() != ""]
+
+    result = []
+    for filename in os.listdir(d):
+        _, ext = os.path.splitext(filename.lower())
+        if ext == ".jpg" or ext == ".png":
+            result.append(os.path.join(d, filename))
+    result.sort()
+    return result
+
+
+def write(encoded, path, replace=False):
+    dirname = os.path.dirname(path)
+    if dirname != "" and not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    if os.path.exists(path) and not replace:
+        raise Exception("file already exists at " + path)
+
+    # write to a temporary file first so that a crash cannot leave a truncated image behind
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(encoded)
+    if os.name == "nt" and os.path.exists(path):
+        # rename only replaces existing files on posix
+        os.remove(path)
+    os.rename(tmp_path, path)
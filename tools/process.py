@@ -7,53 +7,88 @@ import argparse
 import os
 import tempfile
 import subprocess
-import tensorflow as tf
 import numpy as np
-import tfimage as im
 import threading
 import time
 import multiprocessing
+import hashlib
+import json
+import zlib
+import struct
+from multiprocessing.pool import ThreadPool
 
-edge_pool = None
+pipeline = None
+worker_session = None
+b_index = None
+
+JOURNAL_NAME = "journal.txt"
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--input_dir", required=True, help="path to folder containing images")
 parser.add_argument("--output_dir", required=True, help="output path")
-parser.add_argument("--operation", required=True, choices=["grayscale", "resize", "blank", "combine", "edges"])
+parser.add_argument("--operation", required=True, choices=["grayscale", "resize", "blank", "combine", "edges", "prepare"])
 parser.add_argument("--workers", type=int, default=1, help="number of workers")
+parser.add_argument("--processes", action="store_true", help="use worker processes instead of threads, each with its own session")
+parser.add_argument("--chunk_size", type=int, default=16, help="number of images to send to a worker process at a time with --processes or the edges operation")
+parser.add_argument("--backend", default="tf", choices=["tf", "numpy"], help="do image operations with tensorflow or with numpy and pillow (which does not need tensorflow)")
+parser.add_argument("--unfused", action="store_true", help="run each op with its own session.run instead of one fused graph per image (slower, for comparison)")
+parser.add_argument("--unbatched", action="store_true", help="for the edges operation, run HED and the octave post-processing once per image instead of once per chunk (slower, for comparison)")
+parser.add_argument("--verify", action="store_true", help="check the size and checksum of each output listed in the journal and process the ones that do not match again")
 # resize
 parser.add_argument("--pad", action="store_true", help="pad instead of crop for resize operation")
 parser.add_argument("--size", type=int, default=256, help="size to use for resize operation")
 # combine
-parser.add_argument("--b_dir", type=str, help="path to folder containing B images for combine operation")
+parser.add_argument("--b_dir", type=str, help="path to folder containing B images for combine and prepare operations")
+# prepare
+parser.add_argument("--grayscale", action="store_true", help="convert images to grayscale for prepare operation")
+parser.add_argument("--height", type=int, default=64, help="height of each side of the combined image for prepare operation")
+parser.add_argument("--width", type=int, default=256, help="width of each side of the combined image for prepare operation")
+parser.add_argument("--train_frac", type=float, default=0.8, help="percentage of images to use for training set for prepare operation")
+parser.add_argument("--test_frac", type=float, default=0.0, help="percentage of images to use for test set for prepare operation")
+parser.add_argument("--pack", action="store_true", help="write each set of the prepare operation to a single tfrecords file instead of to png files")
 a = parser.parse_args()
 
+if a.backend == "numpy":
+    import npimage as im
+else:
+    import tensorflow as tf
+    import tfimage as im
+
 
 def resize(src):
+    return fit(src, a.size, a.size)
+
+
+def fit(src, target_height, target_width):
+    # crop or pad to the ratio of target_height to target_width and then scale to that size
     height, width, _ = src.shape
     dst = src
-    if height != width:
+    if height * target_width != width * target_height:
         if a.pad:
-            size = max(height, width)
             # pad to correct ratio
-            oh = (size - height) // 2
-            ow = (size - width) // 2
-            dst = im.pad(image=dst, offset_height=oh, offset_width=ow, target_height=size, target_width=size)
+            if height * target_width > width * target_height:
+                size = (height, height * target_width // target_height)
+            else:
+                size = (width * target_height // target_width, width)
+            oh = (size[0] - height) // 2
+            ow = (size[1] - width) // 2
+            dst = im.pad(image=dst, offset_height=oh, offset_width=ow, target_height=size[0], target_width=size[1])
         else:
             # crop to correct ratio
-            size = min(height, width)
-            oh = (height - size) // 2
-            ow = (width - size) // 2
-            dst = im.crop(image=dst, offset_height=oh, offset_width=ow, target_height=size, target_width=size)
-
-    assert(dst.shape[0] == dst.shape[1])
-
-    size, _, _ = dst.shape
-    if size > a.size:
-        dst = im.downscale(images=dst, size=[a.size, a.size])
-    elif size < a.size:
-        dst = im.upscale(images=dst, size=[a.size, a.size])
+            if height * target_width > width * target_height:
+                size = (width * target_height // target_width, width)
+            else:
+                size = (height, height * target_width // target_height)
+            oh = (height - size[0]) // 2
+            ow = (width - size[1]) // 2
+            dst = im.crop(image=dst, offset_height=oh, offset_width=ow, target_height=size[0], target_width=size[1])
+
+    height, width, _ = dst.shape
+    if height > target_height or width > target_width:
+        dst = im.downscale(images=dst, size=[target_height, target_width])
+    elif height < target_height or width < target_width:
+        dst = im.upscale(images=dst, size=[target_height, target_width])
     return dst
 
 
@@ -67,52 +102,149 @@ def blank(src):
     offset = int(image_size / 2 - size / 2)
 
     dst = src
-    dst[offset:offset + size,offset:offset + size,:] = np.ones([size, size, 3])
+    white = 255 if dst.dtype == np.uint8 else 1
+    dst[offset:offset + size,offset:offset + size,:] = white * np.ones([size, size, 3])
     return dst
 
 
+def to_rgb(src):
+    # convert to RGB if necessary
+    if src.shape[2] == 1:
+        src = im.grayscale_to_rgb(images=src)
+
+    # remove alpha channel
+    if src.shape[2] == 4:
+        src = src[:,:,:3]
+    return src
+
+
 def combine(src, src_path):
     if a.b_dir is None:
         raise Exception("missing b_dir")
 
-    # find corresponding file in b_dir, could have a different extension
-    basename, _ = os.path.splitext(os.path.basename(src_path))
-    for ext in [".png", ".jpg"]:
-        sibling_path = os.path.join(a.b_dir, basename + ext)
-        if os.path.exists(sibling_path):
-            sibling = im.load(sibling_path)
-            break
-    else:
-        raise Exception("could not find sibling image for " + src_path)
+    sibling = im.load(find_sibling(src_path))
 
     # make sure that dimensions are correct
     height, width, _ = src.shape
     if height != sibling.shape[0] or width != sibling.shape[1]:
         raise Exception("differing sizes")
     
-    # convert both images to RGB if necessary
-    if src.shape[2] == 1:
-        src = im.grayscale_to_rgb(images=src)
-
-    if sibling.shape[2] == 1:
-        sibling = im.grayscale_to_rgb(images=sibling)
+    return np.concatenate([to_rgb(src), to_rgb(sibling)], axis=1)
 
-    # remove alpha channel
-    if src.shape[2] == 4:
-        src = src[:,:,:3]
-    
-    if sibling.shape[2] == 4:
-        sibling = sibling[:,:,:3]
 
-    return np.concatenate([src, sibling], axis=1)
+def prepare(src, src_path):
+    # resize, convert and combine in one go, without writing any intermediate images
+    images = []
+    for image in [src, im.load(find_sibling(src_path))]:
+        image = fit(to_rgb(image), a.height, a.width)
+        if a.grayscale:
+            image = im.rgb_to_grayscale(images=image)
+        images.append(image)
+    return np.concatenate(images, axis=1)
 
 
 def grayscale(src):
     return im.grayscale_to_rgb(images=im.rgb_to_grayscale(images=src))
 
 
+# graph versions of the operations above, these get built into a single graph for each image
+# by im.create_pipeline so that an image takes one session.run instead of one for each op
+
+def resize_graph(src):
+    # im.create_pipeline decodes one input for each argument
+    return fit_graph(src, a.size, a.size)
+
+
+def fit_graph(src, target_height, target_width):
+    height, width = tf.shape(src)[0], tf.shape(src)[1]
+    taller = height * target_width > width * target_height
+    if a.pad:
+        # pad to correct ratio
+        size_height = tf.where(taller, height, width * target_height // target_width)
+        size_width = tf.where(taller, height * target_width // target_height, width)
+        dst = tf.image.pad_to_bounding_box(src, (size_height - height) // 2, (size_width - width) // 2, size_height, size_width)
+    else:
+        # crop to correct ratio
+        size_height = tf.where(taller, width * target_height // target_width, height)
+        size_width = tf.where(taller, width, height * target_width // target_height)
+        dst = tf.image.crop_to_bounding_box(src, (height - size_height) // 2, (width - size_width) // 2, size_height, size_width)
+
+    larger = tf.logical_or(size_height > target_height, size_width > target_width)
+    smaller = tf.logical_or(size_height < target_height, size_width < target_width)
+    downscale = lambda: tf.image.resize_images(dst, [target_height, target_width], method=tf.image.ResizeMethod.AREA)
+    upscale = lambda: tf.image.resize_images(dst, [target_height, target_width], method=tf.image.ResizeMethod.BICUBIC)
+    return tf.cond(larger, downscale, lambda: tf.cond(smaller, upscale, lambda: dst))
+
+
+def blank_graph(src):
+    height, width = tf.shape(src)[0], tf.shape(src)[1]
+    assertion = tf.assert_equal(height, width, message="non-square image")
+    with tf.control_dependencies([assertion]):
+        image_size = tf.identity(width)
+
+    size = tf.cast(tf.cast(image_size, tf.float64) * 0.3, tf.int32)
+    offset = tf.cast(tf.cast(image_size, tf.float64) / 2 - tf.cast(size, tf.float64) / 2, tf.int32)
+    mask = tf.image.pad_to_bounding_box(tf.ones([size, size, 1]), offset, offset, image_size, image_size)
+    return src * (1 - mask) + mask
+
+
+def combine_graph(src, sibling):
+    # both images are decoded as RGB, which takes care of grayscale images and alpha channels
+    assertion = tf.assert_equal(tf.shape(src)[:2], tf.shape(sibling)[:2], message="differing sizes")
+    with tf.control_dependencies([assertion]):
+        return tf.concat([src, sibling], axis=1)
+
+
+def grayscale_graph(src):
+    return tf.image.grayscale_to_rgb(tf.image.rgb_to_grayscale(src))
+
+
+def prepare_graph(src, sibling):
+    images = []
+    for image in [src, sibling]:
+        image = fit_graph(image, a.height, a.width)
+        if a.grayscale:
+            image = tf.image.rgb_to_grayscale(image)
+        images.append(image)
+    return tf.concat(images, axis=1)
+
+
+def find_sibling(src_path):
+    # find corresponding file in b_dir, could have a different extension
+    global b_index
+    if b_index is None:
+        # list b_dir once instead of checking for each possible sibling of each file
+        b_index = {}
+        for path in im.find(a.b_dir):
+            basename, ext = os.path.splitext(os.path.basename(path))
+            if basename not in b_index or ext.lower() == ".png":
+                b_index[basename] = path
+
+    basename, _ = os.path.splitext(os.path.basename(src_path))
+    if basename not in b_index:
+        raise Exception("could not find sibling image for " + src_path)
+    return b_index[basename]
+
+
+def create_pipeline():
+    if a.operation == "grayscale":
+        return im.create_pipeline(grayscale_graph)
+    elif a.operation == "resize":
+        return im.create_pipeline(resize_graph)
+    elif a.operation == "blank":
+        return im.create_pipeline(blank_graph)
+    elif a.operation == "combine":
+        if a.b_dir is None:
+            raise Exception("missing b_dir")
+        return im.create_pipeline(combine_graph, channels=3)
+    elif a.operation == "prepare":
+        return im.create_pipeline(prepare_graph, channels=3)
+    # edges runs caffe and octave so it cannot be fused
+    return None
+
+
 net = None
-def run_caffe(src):
+def run_caffe(batch):
     # lazy load caffe and create net
     global net
     if net is None:
@@ -123,52 +255,50 @@ def run_caffe(src):
         # and then changing these hardcoded paths
         net = caffe.Net("/opt/caffe/examples/hed/deploy.prototxt", "/opt/caffe/hed_pretrained_bsds.caffemodel", caffe.TEST)
         
-    net.blobs["data"].reshape(1, *src.shape)
-    net.blobs["data"].data[...] = src
+    # [batch, channel, height, width] => [batch, height, width]
+    net.blobs["data"].reshape(*batch.shape)
+    net.blobs["data"].data[...] = batch
     net.forward()
-    return net.blobs["sigmoid-fuse"].data[0][0,:,:]
+    return net.blobs["sigmoid-fuse"].data[:,0,:,:].copy()
 
-    
-def edges(src):
-    # based on https://github.com/phillipi/pix2pix/blob/master/scripts/edges/batch_hed.py
-    # and https://github.com/phillipi/pix2pix/blob/master/scripts/edges/PostprocessHED.m
+
+def postprocess_edges(fuses):
+    # run the octave post-processing on all the images at once, since starting octave takes much longer
+    # than processing an image
     import scipy.io
-    src = src * 255
-    border = 128 # put a padding around images since edge detection seems to detect edge of image
-    src = src[:,:,:3] # remove alpha channel if present
-    src = np.pad(src, ((border, border), (border, border), (0,0)), "reflect")
-    src = src[:,:,::-1]
-    src -= np.array((104.00698793,116.66876762,122.67891434))
-    src = src.transpose((2, 0, 1))
-
-    # [height, width, channels] => [batch, channel, height, width]
-    fuse = edge_pool.apply(run_caffe, [src])
-    fuse = fuse[border:-border, border:-border]
-
-    with tempfile.NamedTemporaryFile(suffix=".png") as png_file, tempfile.NamedTemporaryFile(suffix=".mat") as mat_file:
-        scipy.io.savemat(mat_file.name, {"input": fuse})
+
+    inputs = np.empty([len(fuses)], dtype=object)
+    for i, fuse in enumerate(fuses):
+        inputs[i] = fuse
+
+    with tempfile.NamedTemporaryFile(suffix=".mat") as input_file, tempfile.NamedTemporaryFile(suffix=".mat") as output_file:
+        scipy.io.savemat(input_file.name, {"inputs": inputs})
         
         octave_code = r"""
-E = 1-load(input_path).input;
-E = imresize(E, [image_width,image_width]);
-E = 1 - E;
-E = single(E);
-[Ox, Oy] = gradient(convTri(E, 4), 1);
-[Oxx, ~] = gradient(Ox, 1);
-[Oxy, Oyy] = gradient(Oy, 1);
-O = mod(atan(Oyy .* sign(-Oxy) ./ (Oxx + 1e-5)), pi);
-E = edgesNmsMex(E, O, 1, 5, 1.01, 1);
-E = double(E >= max(eps, threshold));
-E = bwmorph(E, 'thin', inf);
-E = bwareaopen(E, small_edge);
-E = 1 - E;
-E = uint8(E * 255);
-imwrite(E, output_path);
+inputs = load(input_path).inputs;
+outputs = cell(size(inputs));
+for i = 1:numel(inputs)
+  E = 1-inputs{i};
+  E = imresize(E, [image_width,image_width]);
+  E = 1 - E;
+  E = single(E);
+  [Ox, Oy] = gradient(convTri(E, 4), 1);
+  [Oxx, ~] = gradient(Ox, 1);
+  [Oxy, Oyy] = gradient(Oy, 1);
+  O = mod(atan(Oyy .* sign(-Oxy) ./ (Oxx + 1e-5)), pi);
+  E = edgesNmsMex(E, O, 1, 5, 1.01, 1);
+  E = double(E >= max(eps, threshold));
+  E = bwmorph(E, 'thin', inf);
+  E = bwareaopen(E, small_edge);
+  E = 1 - E;
+  outputs{i} = uint8(E * 255);
+end
+save('-mat7-binary', output_path, 'outputs');
 """
 
         config = dict(
-            input_path="'%s'" % mat_file.name,
-            output_path="'%s'" % png_file.name,
+            input_path="'%s'" % input_file.name,
+            output_path="'%s'" % output_file.name,
             image_width=256,
             threshold=25.0/255.0,
             small_edge=5,
@@ -186,10 +316,53 @@ imwrite(E, output_path);
             print("returncode:", e.returncode)
             print("output:", e.output)
             raise
-        return im.load(png_file.name)
+
+        outputs = scipy.io.loadmat(output_file.name)["outputs"]
+        # [height, width] uint8 => [height, width, 1] like loading a grayscale png
+        return [im.to_float32(image=output[:,:,np.newaxis]) for output in outputs.flatten()]
+
+
+def edges(srcs):
+    # based on https://github.com/phillipi/pix2pix/blob/master/scripts/edges/batch_hed.py
+    # and https://github.com/phillipi/pix2pix/blob/master/scripts/edges/PostprocessHED.m
+    border = 128 # put a padding around images since edge detection seems to detect edge of image
+    inputs = []
+    for src in srcs:
+        if src.dtype == np.uint8:
+            src = src.astype(np.float32)
+        else:
+            src = src * 255
+        src = src[:,:,:3] # remove alpha channel if present
+        src = np.pad(src, ((border, border), (border, border), (0,0)), "reflect")
+        src = src[:,:,::-1]
+        src -= np.array((104.00698793,116.66876762,122.67891434))
+        # [height, width, channels] => [channel, height, width]
+        inputs.append(src.transpose((2, 0, 1)))
+
+    # run images of the same size through the net together
+    fuses = [None] * len(inputs)
+    shapes = {}
+    for i, src in enumerate(inputs):
+        shapes.setdefault(src.shape, []).append(i)
+
+    for indices in shapes.values():
+        batch = np.stack([inputs[i] for i in indices])
+        for i, fuse in zip(indices, run_caffe(batch)):
+            fuses[i] = fuse[border:-border, border:-border]
+
+    return postprocess_edges(fuses)
 
 
 def process(src_path, dst_path):
+    # returns a (set, name, contents) record instead of writing the output when packing
+    # and a (path, size, checksum) journal entry otherwise
+    if pipeline is not None:
+        if a.operation in ["combine", "prepare"]:
+            encoded = pipeline(src_path, find_sibling(src_path))
+        else:
+            encoded = pipeline(src_path)
+        return output(encoded, dst_path)
+
     src = im.load(src_path)
 
     if a.operation == "grayscale":
@@ -200,12 +373,112 @@ def process(src_path, dst_path):
         dst = blank(src)
     elif a.operation == "combine":
         dst = combine(src, src_path)
-    elif a.operation == "edges":
-        dst = edges(src)
+    elif a.operation == "prepare":
+        dst = prepare(src, src_path)
     else:
         raise Exception("invalid operation")
 
-    im.save(dst, dst_path)
+    return output(im.encode(dst, ".png"), dst_path)
+
+
+def output(encoded, dst_path):
+    if a.pack:
+        # the set is the name of the directory the image would have been written to
+        return os.path.basename(os.path.dirname(dst_path)), os.path.basename(dst_path), encoded
+    # outputs that are not in the journal may be left over from an interrupted run
+    im.write(encoded, dst_path, replace=True)
+    return os.path.relpath(dst_path, a.output_dir), len(encoded), checksum(encoded)
+
+
+def checksum(contents):
+    return "%08x" % (zlib.crc32(contents) & 0xffffffff)
+
+
+journal = None
+journal_lock = threading.Lock()
+
+def load_journal():
+    # each line is "<path relative to output_dir>\t<size>\t<crc32>" for an output that has been written completely
+    entries = {}
+    with open(os.path.join(a.output_dir, JOURNAL_NAME)) as f:
+        for line in f:
+            # the last line may have been cut short by a crash
+            if not line.endswith("\n"):
+                continue
+            fields = line[:-1].split("\t")
+            if len(fields) != 3:
+                continue
+            path, size, crc = fields
+            entries[path] = (int(size), crc)
+    return entries
+
+
+def save_journal(entries):
+    path = os.path.join(a.output_dir, JOURNAL_NAME)
+    with open(path + ".tmp", "w") as f:
+        for entry_path, (size, crc) in sorted(entries.items()):
+            f.write("%s\t%d\t%s\n" % (entry_path, size, crc))
+    if os.name == "nt" and os.path.exists(path):
+        os.remove(path)
+    os.rename(path + ".tmp", path)
+
+
+def journal_write(entry):
+    with journal_lock:
+        journal.write("%s\t%d\t%s\n" % entry)
+        journal.flush()
+
+
+def existing_entry(path):
+    # entry for an output that already exists, or None if it is not a complete png, which an interrupted run
+    # from before there was a journal could have left behind, every chunk is checked and the image data
+    # decompressed, which needs neither a session nor the numpy backend
+    contents = im.read(os.path.join(a.output_dir, path))
+    if contents[:8] != b"\x89PNG\r\n\x1a\n":
+        return None
+
+    offset = 8
+    header = None
+    data = []
+    while offset + 12 <= len(contents):
+        length, kind = struct.unpack(">I4s", contents[offset:offset + 8])
+        end = offset + 8 + length
+        if end + 4 > len(contents):
+            return None
+        crc, = struct.unpack(">I", contents[end:end + 4])
+        if zlib.crc32(contents[offset + 4:end]) & 0xffffffff != crc:
+            return None
+        if kind == b"IHDR":
+            header = contents[offset + 8:end]
+        elif kind == b"IDAT":
+            data.append(contents[offset + 8:end])
+        elif kind == b"IEND":
+            break
+        offset = end + 4
+    else:
+        return None
+
+    if header is None or len(header) != 13:
+        return None
+    width, height, bit_depth, color_type, _, _, interlace = struct.unpack(">IIBBBBB", header)
+    try:
+        pixels = zlib.decompress(b"".join(data))
+    except zlib.error:
+        return None
+    if interlace == 0:
+        channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}.get(color_type, 0)
+        # each row starts with a filter type byte
+        if len(pixels) != height * ((width * channels * bit_depth + 7) // 8 + 1):
+            return None
+    return len(contents), checksum(contents)
+
+
+def verify(item):
+    path, (size, crc) = item
+    full_path = os.path.join(a.output_dir, path)
+    if not os.path.exists(full_path) or os.path.getsize(full_path) != size:
+        return False
+    return checksum(im.read(full_path)) == crc
 
 
 complete_lock = threading.Lock()
@@ -213,11 +486,11 @@ start = None
 num_complete = 0
 total = 0
 
-def complete():
+def complete(count=1):
     global num_complete, rate, last_complete
 
     with complete_lock:
-        num_complete += 1
+        num_complete += count
         now = time.time()
         elapsed = now - start
         rate = num_complete / elapsed
@@ -231,6 +504,89 @@ def complete():
         last_complete = now
 
 
+def init_worker():
+    # each worker process gets its own session, the graph is normally inherited from the parent process
+    global pipeline, worker_session
+    if a.backend == "tf":
+        if pipeline is None and not a.unfused:
+            pipeline = create_pipeline()
+        worker_session = tf.Session()
+
+
+def process_chunk(chunk):
+    # results are sent back to the parent process, which has the only journal and writer for each set
+    if worker_session is None:
+        results = run_chunk(chunk)
+    else:
+        with worker_session.as_default():
+            results = run_chunk(chunk)
+    return len(chunk), results
+
+
+def run_chunk(chunk):
+    if a.operation == "edges":
+        # edge detection is much faster on a whole chunk at a time
+        srcs = [im.load(src_path) for src_path, _ in chunk]
+        if a.unbatched:
+            dsts = [edges([src])[0] for src in srcs]
+        else:
+            dsts = edges(srcs)
+        return [output(im.encode(dst, ".png"), dst_path) for (_, dst_path), dst in zip(chunk, dsts)]
+    return [process(src_path, dst_path) for src_path, dst_path in chunk]
+
+
+pack_writers = {}
+pack_counts = {}
+pack_lock = threading.Lock()
+
+def finish(result):
+    # record the result of process in the main process
+    if a.pack:
+        write_record(result)
+    else:
+        journal_write(result)
+
+
+def write_record(record):
+    # append a (set, name, contents) record returned by process to the tfrecords file for its set
+    # the numpy backend only needs tensorflow when packing
+    import tensorflow as tf
+    dirname, name, contents = record
+    with pack_lock:
+        if dirname not in pack_writers:
+            path = os.path.join(a.output_dir, dirname, "examples.tfrecords")
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            pack_writers[dirname] = tf.python_io.TFRecordWriter(path)
+            pack_counts[dirname] = 0
+
+        example = tf.train.Example(features=tf.train.Features(feature={
+            "path": tf.train.Feature(bytes_list=tf.train.BytesList(value=[name.encode("utf8")])),
+            "image": tf.train.Feature(bytes_list=tf.train.BytesList(value=[contents])),
+        }))
+        pack_writers[dirname].write(example.SerializeToString())
+        pack_counts[dirname] += 1
+
+
+def close_records():
+    for dirname, writer in pack_writers.items():
+        writer.close()
+        # pix2pix.py reads the number of examples from here instead of counting the records
+        with open(os.path.join(a.output_dir, dirname, "examples.json"), "w") as f:
+            f.write(json.dumps({"count": pack_counts[dirname]}))
+
+
+def assign_set(name):
+    # same assignments as tools/split.py --manifest, a stable hash of the name, so an image stays
+    # in the same set when images are added to the dataset
+    value = int(hashlib.md5(name.encode("utf8")).hexdigest()[:8], 16) / 2**32
+    if value < a.train_frac:
+        return "train"
+    if value < a.train_frac + a.test_frac:
+        return "test"
+    return "val"
+
+
 def main():
     if not os.path.exists(a.output_dir):
         os.makedirs(a.output_dir)
@@ -238,36 +594,111 @@ def main():
     src_paths = []
     dst_paths = []
 
+    if a.pack and a.operation != "prepare":
+        raise Exception("--pack requires the prepare operation")
+
+    if a.operation == "prepare" and a.b_dir is None:
+        raise Exception("missing b_dir")
+
+    all_src_paths = im.find(a.input_dir)
+
+    # the journal lists the outputs that have been written completely, so that an interrupted run
+    # can continue without checking for every output file, packed outputs are always written again
+    entries = {}
+    has_journal = os.path.exists(os.path.join(a.output_dir, JOURNAL_NAME))
+    if has_journal and not a.pack:
+        entries = load_journal()
+        if a.verify:
+            pool = ThreadPool(a.workers)
+            items = sorted(entries.items())
+            failed = [path for (path, _), ok in zip(items, pool.map(verify, items)) if not ok]
+            pool.close()
+            for path in failed:
+                del entries[path]
+            print("%d/%d outputs failed verification" % (len(failed), len(items)))
+
     skipped = 0
-    for src_path in im.find(a.input_dir):
+    existing = []
+    for src_path in all_src_paths:
         name, _ = os.path.splitext(os.path.basename(src_path))
-        dst_path = os.path.join(a.output_dir, name + ".png")
-        if os.path.exists(dst_path):
-            skipped += 1
+        if a.operation == "prepare":
+            dst_path = os.path.join(a.output_dir, assign_set(name + ".png"), name + ".png")
         else:
-            src_paths.append(src_path)
-            dst_paths.append(dst_path)
+            dst_path = os.path.join(a.output_dir, name + ".png")
+        path = os.path.relpath(dst_path, a.output_dir)
+        if a.pack:
+            pass
+        elif path in entries:
+            skipped += 1
+            continue
+        elif not has_journal and os.path.exists(dst_path):
+            existing.append((src_path, dst_path))
+            continue
+        src_paths.append(src_path)
+        dst_paths.append(dst_path)
+
+    if len(existing) > 0:
+        # output directory from before there was a journal, add the existing outputs that are complete to it once
+        # and process the others again
+        pool = ThreadPool(a.workers)
+        paths = [os.path.relpath(dst_path, a.output_dir) for _, dst_path in existing]
+        incomplete = 0
+        for (src_path, dst_path), path, entry in zip(existing, paths, pool.map(existing_entry, paths)):
+            if entry is None:
+                src_paths.append(src_path)
+                dst_paths.append(dst_path)
+                incomplete += 1
+            else:
+                entries[path] = entry
+                skipped += 1
+        pool.close()
+        print("%d/%d existing outputs without a journal entry were incomplete" % (incomplete, len(existing)))
     
-    print("skipping %d files that already exist" % skipped)
+    print("skipping %d files that were already completed" % skipped)
+
+    if not a.pack:
+        # rewrite the journal with only the entries that were loaded, verified or found
+        global journal
+        save_journal(entries)
+        journal = open(os.path.join(a.output_dir, JOURNAL_NAME), "a")
             
     global total
     total = len(src_paths)
     
     print("processing %d files" % total)
 
+    if a.backend == "tf" and not a.unfused:
+        global pipeline
+        pipeline = create_pipeline()
+
     global start
     start = time.time()
     
-    if a.operation == "edges":
-        # use a multiprocessing pool for this operation so it can use multiple CPUs
-        # create the pool before we launch processing threads
-        global edge_pool
-        edge_pool = multiprocessing.Pool(a.workers)
-
-    if a.workers == 1:
+    if a.processes or a.operation == "edges":
+        # send chunks of work to the worker processes so that none of the python side of the
+        # processing is serialized by the GIL, and report progress as each chunk finishes
+        # no session may be created in this process before the pool forks
+        chunks = []
+        for i in range(0, total, a.chunk_size):
+            chunks.append(list(zip(src_paths[i:i + a.chunk_size], dst_paths[i:i + a.chunk_size])))
+        pool = multiprocessing.Pool(a.workers, initializer=init_worker)
+        for count, results in pool.imap_unordered(process_chunk, chunks):
+            for result in results:
+                finish(result)
+            complete(count)
+        pool.close()
+        pool.join()
+    elif a.backend == "numpy":
+        # no sessions needed, and pillow and numpy release the GIL for most of the work
+        pool = ThreadPool(a.workers)
+        for result in pool.imap_unordered(lambda paths: process(*paths), zip(src_paths, dst_paths)):
+            finish(result)
+            complete()
+        pool.close()
+    elif a.workers == 1:
         with tf.Session() as sess:
             for src_path, dst_path in zip(src_paths, dst_paths):
-                process(src_path, dst_path)
+                finish(process(src_path, dst_path))
                 complete()
     else:
         queue = tf.train.input_producer(zip(src_paths, dst_paths), shuffle=False, num_epochs=1)
@@ -282,7 +713,7 @@ def main():
                         coord.request_stop()
                         break
 
-                    process(src_path, dst_path)
+                    finish(process(src_path.decode("utf8"), dst_path.decode("utf8")))
                     complete()
 
         # init epoch counter for the queue
@@ -303,4 +734,8 @@ def main():
                 coord.request_stop()
                 coord.join(threads)
 
+    close_records()
+    if journal is not None:
+        journal.close()
+
 main()
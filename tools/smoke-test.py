@@ -0,0 +1,168 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# end to end check on the CPU with a small synthetic dataset: train, test, export, serve a request and
+# predict in bulk, recording how long each stage takes and comparing against a stored baseline
+
+try:
+    from urllib.request import urlopen # python 3
+except ImportError:
+    from urllib2 import urlopen # python 2
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+tools_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(tools_dir)
+sys.path.insert(0, tools_dir)
+import npimage
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--work_dir", help="directory to write the dataset and outputs to, a temporary directory if not specified")
+parser.add_argument("--count", type=int, default=24, help="number of training images to generate, a third as many validation images are generated")
+parser.add_argument("--max_steps", type=int, default=20, help="number of training steps")
+parser.add_argument("--batch_size", type=int, default=4, help="batch size for training and testing")
+parser.add_argument("--model", default="convolution", choices=["convolution", "lstm"], help="generator to use")
+parser.add_argument("--ngf", type=int, default=8, help="number of generator filters, small to keep the test quick")
+parser.add_argument("--ndf", type=int, default=8, help="number of discriminator filters, small to keep the test quick")
+parser.add_argument("--port", type=int, default=8765, help="port to run server/serve.py on")
+parser.add_argument("--baseline", help="json file with the timings of a previous run to compare against")
+parser.add_argument("--save_baseline", action="store_true", help="write the timings of this run to --baseline instead of comparing against it")
+parser.add_argument("--threshold", type=float, default=0.5, help="fraction that a stage may be slower than the baseline before it counts as a regression")
+a = parser.parse_args()
+
+env = dict(os.environ)
+env["CUDA_VISIBLE_DEVICES"] = ""
+env["PYTHONUNBUFFERED"] = "x"
+
+
+def generate(d, count, seed):
+    # the A side is a smooth random pattern and the B side is its inverse, which the model can learn quickly
+    rng = np.random.RandomState(seed)
+    os.makedirs(os.path.join(d, "pairs"))
+    os.makedirs(os.path.join(d, "inputs"))
+    for i in range(count):
+        pattern = rng.rand(8 + 1, 32 + 1)
+        pattern = np.kron(pattern, np.ones([8, 8]))[:64, :256]
+        a_image = (pattern * 255).astype(np.uint8)
+        pair = np.concatenate([a_image, 255 - a_image], axis=1)[:, :, np.newaxis]
+        npimage.write(npimage.encode(pair, ".png"), os.path.join(d, "pairs", "%d.png" % i))
+        npimage.write(npimage.encode(a_image[:, :, np.newaxis], ".png"), os.path.join(d, "inputs", "%d.png" % i))
+
+
+def run(args):
+    print(" ".join(args))
+    sys.stdout.flush()
+    subprocess.check_call([sys.executable] + args, env=env)
+
+
+def pix2pix(mode, output_dir, *args):
+    run([os.path.join(root_dir, "pix2pix.py"), "--mode", mode, "--output_dir", output_dir, "--seed", "0"] + list(args))
+
+
+def wait_for_port(port, process, timeout=300):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise Exception("server exited with code %d" % process.returncode)
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except socket.error:
+            time.sleep(0.2)
+    raise Exception("server did not start within %ds" % timeout)
+
+
+def main():
+    work_dir = a.work_dir
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp()
+    elif os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+
+    train_dir = os.path.join(work_dir, "train")
+    val_dir = os.path.join(work_dir, "val")
+    train_output_dir = os.path.join(work_dir, "train_output")
+    model_args = ["--" + a.model, "True", "--ngf", str(a.ngf), "--ndf", str(a.ndf)]
+    val_count = max(a.count // 3, 1)
+
+    timings = {}
+    def stage(name, images, func, *args):
+        print("stage", name)
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+        timings[name] = {"seconds": elapsed, "images_per_second": images / elapsed if images > 0 else None}
+
+    stage("generate", a.count + val_count, lambda: (generate(train_dir, a.count, 0), generate(val_dir, val_count, 1)))
+
+    stage("train", a.max_steps * a.batch_size, pix2pix, "train", train_output_dir,
+        "--input_dir", os.path.join(train_dir, "pairs"), "--max_steps", str(a.max_steps), "--batch_size", str(a.batch_size),
+        "--summary_freq", "0", "--progress_freq", "0", "--save_freq", str(a.max_steps), *model_args)
+
+    # test mode processes whole batches
+    stage("test", val_count // a.batch_size * a.batch_size, pix2pix, "test", os.path.join(work_dir, "test_output"),
+        "--input_dir", os.path.join(val_dir, "pairs"), "--checkpoint", train_output_dir, "--batch_size", str(a.batch_size))
+
+    models_dir = os.path.join(work_dir, "models")
+    export_dir = os.path.join(models_dir, "smoke")
+    stage("export", 0, pix2pix, "export", export_dir, "--checkpoint", train_output_dir)
+
+    server = subprocess.Popen([sys.executable, os.path.join(root_dir, "server", "serve.py"), "--local_models_dir", models_dir, "--port", str(a.port)], env=env)
+    try:
+        stage("serve_startup", 0, wait_for_port, a.port, server)
+
+        def request():
+            with open(os.path.join(val_dir, "inputs", "0.png"), "rb") as f:
+                output = urlopen("http://127.0.0.1:%d/smoke" % a.port, data=f.read()).read()
+            if npimage.decode(output).shape[:2] != (64, 256):
+                raise Exception("server returned an image of the wrong size")
+        stage("serve_request", 1, request)
+    finally:
+        server.terminate()
+        server.wait()
+
+    stage("bulk", val_count, run, [os.path.join(root_dir, "server", "tools", "process-bulk.py"), "--model_dir", export_dir,
+        "--input_dir", os.path.join(val_dir, "inputs"), "--output_dir", os.path.join(work_dir, "bulk_output"), "--batch_size", str(a.batch_size)])
+
+    print()
+    print("%-14s %10s %12s" % ("stage", "seconds", "images/sec"))
+    for name, timing in sorted(timings.items(), key=lambda item: item[0]):
+        rate = "-" if timing["images_per_second"] is None else "%0.1f" % timing["images_per_second"]
+        print("%-14s %10.2f %12s" % (name, timing["seconds"], rate))
+
+    if a.work_dir is None:
+        shutil.rmtree(work_dir)
+
+    if a.baseline is None:
+        return
+
+    if a.save_baseline:
+        with open(a.baseline, "w") as f:
+            f.write(json.dumps(timings, sort_keys=True, indent=4))
+        print("wrote baseline to", a.baseline)
+        return
+
+    with open(a.baseline) as f:
+        baseline = json.loads(f.read())
+
+    regressions = []
+    for name, timing in sorted(timings.items()):
+        if name in baseline and timing["seconds"] > baseline[name]["seconds"] * (1 + a.threshold):
+            regressions.append("%s took %0.2fs, baseline %0.2fs" % (name, timing["seconds"], baseline[name]["seconds"]))
+
+    for regression in regressions:
+        print("REGRESSION", regression)
+    if len(regressions) > 0:
+        sys.exit(1)
+
+main()
@@ -5,6 +5,7 @@ from __future__ import print_function
 import random
 import argparse
 import glob
+import hashlib
 import os
 
 
@@ -13,10 +14,43 @@ parser.add_argument("--dir", type=str, required=True, help="path to folder conta
 parser.add_argument("--train_frac", type=float, default=0.8, help="percentage of images to use for training set")
 parser.add_argument("--test_frac", type=float, default=0.0, help="percentage of images to use for test set")
 parser.add_argument("--sort", action="store_true", help="if set, sort the images instead of shuffling them")
+parser.add_argument("--manifest", action="store_true", help="write train.txt, val.txt and test.txt listing the images in each set instead of moving the images")
 a = parser.parse_args()
 
 
+def assign(name):
+    # a stable hash of the name, so an image stays in the same set when images are added to the dataset
+    value = int(hashlib.md5(name.encode("utf8")).hexdigest()[:8], 16) / 2**32
+    if value < a.train_frac:
+        return "train"
+    if value < a.train_frac + a.test_frac:
+        return "test"
+    return "val"
+
+
+def write_manifests():
+    names = sorted(name for name in os.listdir(a.dir) if name.lower().endswith(".png"))
+
+    sets = {"train": [], "val": [], "test": []}
+    for name in names:
+        sets[assign(name)].append(name)
+
+    for set_name, set_names in sets.items():
+        path = os.path.join(a.dir, set_name + ".txt")
+        with open(path + ".tmp", "w") as f:
+            for name in set_names:
+                f.write(name + "\n")
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(path + ".tmp", path)
+        print(path, len(set_names))
+
+
 def main():
+    if a.manifest:
+        write_manifests()
+        return
+
     random.seed(0)
 
     files = glob.glob(os.path.join(a.dir, "*.png"))
@@ -4,6 +4,7 @@ from __future__ import print_function
 
 import tensorflow as tf
 import os
+import itertools
 
 
 def create_op(func, **placeholders):
@@ -94,6 +95,57 @@ to_float32 = create_op(
 )
 
 
+def decode_graph(contents, ext, channels=0):
+    # graph version of load, returns a float32 image
+    if ext == ".jpg":
+        image = tf.image.decode_jpeg(contents, channels=channels)
+    elif ext == ".png":
+        image = tf.image.decode_png(contents, channels=channels)
+    else:
+        raise Exception("invalid image suffix")
+    return tf.image.convert_image_dtype(image, dtype=tf.float32)
+
+
+def encode_graph(image, ext):
+    # graph version of the encoding part of save, takes a float32 image
+    image = tf.image.convert_image_dtype(image, dtype=tf.uint8, saturate=True)
+    if ext == ".jpg":
+        return tf.image.encode_jpeg(image)
+    elif ext == ".png":
+        return tf.image.encode_png(image)
+    else:
+        raise Exception("invalid image suffix")
+
+
+def create_pipeline(func, channels=0, exts=(".png", ".jpg"), out_ext=".png"):
+    # build func, which maps float32 image tensors to a float32 image tensor, into a single graph that
+    # goes from the contents of the input files to the contents of the output file, for each combination
+    # of input file types, so that each image takes one session.run instead of one for each op
+    ops = {}
+    num_inputs = func.__code__.co_argcount
+    for input_exts in itertools.product(exts, repeat=num_inputs):
+        contents = [tf.placeholder(tf.string, []) for _ in input_exts]
+        images = [decode_graph(c, ext, channels=channels) for c, ext in zip(contents, input_exts)]
+        ops[input_exts] = (contents, encode_graph(func(*images), out_ext))
+
+    def f(*paths):
+        input_exts = tuple(os.path.splitext(path.lower())[1] for path in paths)
+        if input_exts not in ops:
+            raise Exception("invalid image suffix")
+        contents, op = ops[input_exts]
+        feed_dict = {}
+        for placeholder, path in zip(contents, paths):
+            feed_dict[placeholder] = read(path)
+        return tf.get_default_session().run(op, feed_dict=feed_dict)
+
+    return f
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
 def load(path):
     with open(path, "rb") as f:
         contents = f.read()
@@ -111,6 +163,11 @@ def load(path):
 
 
 def find(d):
+    if os.path.isfile(d):
+        # split manifest written by split.py --manifest, with one image name per line
+        with open(d) as f:
+            return [os.path.join(os.path.dirname(d), line.rstrip("\n")) for line in f if line.strip() != ""]
+
     result = []
     for filename in os.listdir(d):
         _, ext = os.path.splitext(filename.lower())
@@ -120,25 +177,34 @@ def find(d):
     return result
 
 
-def save(image, path, replace=False):
-    _, ext = os.path.splitext(path.lower())
+def encode(image, ext):
     image = to_uint8(image=image)
     if ext == ".jpg":
-        encoded = encode_jpeg(image=image)
+        return encode_jpeg(image=image)
     elif ext == ".png":
-        encoded = encode_png(image=image)
+        return encode_png(image=image)
     else:
         raise Exception("invalid image suffix")
 
+
+def save(image, path, replace=False):
+    _, ext = os.path.splitext(path.lower())
+    write(encode(image, ext), path, replace=replace)
+
+
+def write(encoded, path, replace=False):
     dirname = os.path.dirname(path)
     if dirname != "" and not os.path.exists(dirname):
         os.makedirs(dirname)
 
-    if os.path.exists(path):
-        if replace:
-            os.remove(path)
-        else:
-            raise Exception("file already exists at " + path)
+    if os.path.exists(path) and not replace:
+        raise Exception("file already exists at " + path)
 
-    with open(path, "wb") as f:
+    # write to a temporary file first so that a crash cannot leave a truncated image behind
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
         f.write(encoded)
+    if os.name == "nt" and os.path.exists(path):
+        # rename only replaces existing files on posix
+        os.remove(path)
+    os.rename(tmp_path, path)
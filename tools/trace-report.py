@@ -0,0 +1,68 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# aggregates the op times in the timeline-*.json files written by pix2pix.py --trace_freq
+
+import argparse
+import collections
+import glob
+import json
+import os
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--dir", required=True, help="output_dir of a training run with --trace_freq")
+parser.add_argument("--top", type=int, default=20, help="number of hot spots to list for each grouping")
+parser.add_argument("--depth", type=int, default=2, help="number of name scopes to group ops by, e.g. 2 for generator/encoder_2")
+a = parser.parse_args()
+
+
+def scope(node_name):
+    # gradient ops are named after the op they differentiate, e.g. generator_train/gradients/generator/encoder_2/...
+    # so count them towards that scope as well, but separately from the forward pass
+    direction = "forward"
+    if "gradients/" in node_name:
+        node_name = node_name.split("gradients/", 1)[1]
+        direction = "backward"
+    parts = node_name.split("/")[:-1]
+    if len(parts) == 0:
+        return "(root)", direction
+    return "/".join(parts[:a.depth]), direction
+
+
+def report(title, totals, step_time):
+    print(title)
+    print("%12s  %7s  %s" % ("ms", "share", "name"))
+    for name, duration in sorted(totals.items(), key=lambda item: -item[1])[:a.top]:
+        print("%12.1f  %6.1f%%  %s" % (duration / 1000, duration / step_time * 100, name))
+    print()
+
+
+def main():
+    paths = sorted(glob.glob(os.path.join(a.dir, "timeline-*.json")))
+    if len(paths) == 0:
+        raise Exception("no timeline files found, train with --trace_freq to write them")
+
+    by_type = collections.defaultdict(float)
+    by_scope = collections.defaultdict(float)
+    step_time = 0
+    for path in paths:
+        with open(path) as f:
+            events = [event for event in json.load(f)["traceEvents"] if event.get("ph") == "X" and event.get("cat") == "Op"]
+        if len(events) == 0:
+            continue
+        # ops run in parallel, so the step time is from the first op starting to the last one finishing
+        step_time += max(event["ts"] + event["dur"] for event in events) - min(event["ts"] for event in events)
+        for event in events:
+            args = event.get("args", {})
+            by_type[args.get("op", event["name"])] += event["dur"]
+            by_scope["%s (%s)" % scope(args.get("name", event["name"]))] += event["dur"]
+
+    print("%d traced steps, %0.1fms per step" % (len(paths), step_time / len(paths) / 1000))
+    print("ops run in parallel, so shares of step time can add up to more than 100%")
+    print()
+    report("by op type", by_type, step_time)
+    report("by scope", by_scope, step_time)
+
+main()